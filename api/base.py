@@ -0,0 +1,314 @@
+import ast
+import json
+import time
+import asyncio
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from .rate_limiter import get_rate_limiter, get_limiter_name, parse_retry_after, RateLimiterError
+from .cache import cache_key
+from .transport import get_transport
+from .resilience import APIError, ResponseParseError, RetryPolicy, LatencyTracker, get_circuit_breaker
+from telemetry import get_telemetry
+
+
+# Rough per-image prompt cost used for tokens/min accounting; both providers
+# bill a small crop at a few hundred tokens.
+IMAGE_TOKENS = 258
+
+
+def estimate_tokens(payload):
+    if isinstance(payload, dict):
+        if "image_url" in payload or "inline_data" in payload:
+            return IMAGE_TOKENS
+        return sum(estimate_tokens(value) for value in payload.values())
+    if isinstance(payload, list):
+        return sum(estimate_tokens(value) for value in payload)
+    if isinstance(payload, str):
+        return len(payload) // 4
+    return 0
+
+
+LABELS = ["Round", "Spindle", "Polygonal", "None"]
+
+
+def parse_batch_labels(text, num_patches):
+    # Returns one label per patch, or None if the answer can't be mapped back
+    # onto the patches (callers then fall back to single-patch requests).
+    text = text.strip()
+    if text.startswith("```"):
+        text = text.strip("`")
+        text = text[text.index("\n") + 1:] if "\n" in text else text
+    try:
+        labels = json.loads(text)
+    except ValueError:
+        try:
+            labels = ast.literal_eval(text)
+        except (ValueError, SyntaxError):
+            return None
+
+    if isinstance(labels, dict):
+        labels = next((value for value in labels.values() if isinstance(value, list)), None)
+    if not isinstance(labels, list) or len(labels) != num_patches:
+        return None
+
+    parsed = []
+    for label in labels:
+        if isinstance(label, dict):
+            label = label.get("Classification", label.get("classification", "None"))
+        label = str(label).strip().strip('"\'').capitalize()
+        parsed.append(label if label in LABELS else "None")
+    return parsed
+
+
+class BaseAPI:
+    # Shared request loop for the VLM clients. Subclasses set self.url and
+    # self.headers and implement build_payload / parse_response.
+    provider = None
+
+    def __init__(self, api_key, model, retries=10, delay=5, requests_per_minute=60, tokens_per_minute=None, cache=None,
+                 resilience=None, rate_limit_dir=None):
+        resilience = resilience or {}
+        self.api_key = api_key
+        self.model = model
+        self.retries = retries
+        self.delay = delay  # fallback wait for a 429 without Retry-After
+        self.cache = cache
+        self.transport = get_transport()
+        self.rate_limiter = get_rate_limiter(get_limiter_name(self.provider, api_key, model), requests_per_minute,
+                                             tokens_per_minute, rate_limit_dir)
+        self.retry_policy = RetryPolicy(retries, resilience.get("base_delay", 1.0), resilience.get("max_delay", 60.0))
+        self.circuit_breaker = get_circuit_breaker(self.provider, resilience.get("failure_threshold", 5),
+                                                   resilience.get("reset_timeout", 60.0))
+        self.hedge = resilience.get("hedge", False)
+        self.latency = LatencyTracker()
+        self.hedge_pool = ThreadPoolExecutor(resilience.get("hedge_workers", 8)) if self.hedge else None
+
+    def request_url(self):
+        return self.url
+
+    def build_payload(self, inputs: dict, example_pairs) -> dict:
+        raise NotImplementedError
+
+    def parse_response(self, result: dict) -> str:
+        raise NotImplementedError
+
+    def build_batch_payload(self, inputs: dict, example_pairs) -> dict:
+        raise NotImplementedError
+
+    def extract_text(self, result: dict) -> str:
+        raise NotImplementedError
+
+    def get_shape_information(self, inputs: dict, example_pairs) -> str:
+        key = cache_key(self.url, self.model, inputs, example_pairs) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        result = self.post(self.build_payload(inputs, example_pairs))
+        if key is not None and result is not None:
+            self.cache.put(key, result)
+        return result
+
+    async def aget_shape_information(self, inputs: dict, example_pairs, session) -> str:
+        key = cache_key(self.url, self.model, inputs, example_pairs) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        result = await self.apost(self.build_payload(inputs, example_pairs), session)
+        if key is not None and result is not None:
+            self.cache.put(key, result)
+        return result
+
+    def get_shape_information_batch(self, inputs: dict, example_pairs) -> list:
+        # inputs["images"] holds several patches that share one prompt and one
+        # copy of the few-shot examples.
+        key = cache_key(self.url, self.model, inputs, example_pairs) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        text = self.post(self.build_batch_payload(inputs, example_pairs), self.extract_text)
+        if text is None:
+            # the request failed after its retries: the patches stay unlabelled, as
+            # with a failed single-patch call, instead of being retried one by one
+            return [None] * len(inputs["images"])
+        result = parse_batch_labels(text, len(inputs["images"]))
+        if key is not None and result is not None:
+            self.cache.put(key, result)
+        return result
+
+    async def aget_shape_information_batch(self, inputs: dict, example_pairs, session) -> list:
+        key = cache_key(self.url, self.model, inputs, example_pairs) if self.cache is not None else None
+        if key is not None:
+            cached = self.cache.get(key)
+            if cached is not None:
+                return cached
+
+        text = await self.apost(self.build_batch_payload(inputs, example_pairs), session, self.extract_text)
+        if text is None:
+            # the request failed after its retries: the patches stay unlabelled, as
+            # with a failed single-patch call, instead of being retried one by one
+            return [None] * len(inputs["images"])
+        result = parse_batch_labels(text, len(inputs["images"]))
+        if key is not None and result is not None:
+            self.cache.put(key, result)
+        return result
+
+    def parse_or_raise(self, parse, result):
+        try:
+            return parse(result)
+        except Exception as e:
+            raise ResponseParseError(str(e))
+
+    def send(self, payload, parse, tokens):
+        # One HTTP attempt: the parsed result, or APIError / a network error
+        telemetry = get_telemetry()
+        telemetry.observe("limiter_wait_seconds", self.rate_limiter.wait(tokens), provider=self.provider)
+        start = time.monotonic()
+        response = self.transport.post(self.request_url(), self.headers, payload)
+        telemetry.observe("request_seconds", time.monotonic() - start, provider=self.provider)
+        telemetry.count("requests_total", provider=self.provider, status=response.status_code)
+        telemetry.count("bytes_received_total", len(response.content))
+        if response.status_code == 200:
+            result = self.parse_or_raise(parse, response.json())
+            self.latency.record(time.monotonic() - start)
+            return result
+        if response.status_code == 429:
+            self.rate_limiter.penalize(parse_retry_after(response.headers, self.delay))
+        raise APIError(response.status_code, response.text)
+
+    async def asend(self, payload, session, parse, tokens):
+        telemetry = get_telemetry()
+        telemetry.observe("limiter_wait_seconds", await self.rate_limiter.async_wait(tokens), provider=self.provider)
+        start = time.monotonic()
+        async with self.transport.apost(session, self.request_url(), self.headers, payload) as response:
+            body = await response.read()
+            telemetry.observe("request_seconds", time.monotonic() - start, provider=self.provider)
+            telemetry.count("requests_total", provider=self.provider, status=response.status)
+            telemetry.count("bytes_received_total", len(body))
+            if response.status == 200:
+                result = self.parse_or_raise(parse, json.loads(body))
+                self.latency.record(time.monotonic() - start)
+                return result
+            if response.status == 429:
+                self.rate_limiter.penalize(parse_retry_after(response.headers, self.delay))
+            raise APIError(response.status, await response.text())
+
+    def send_hedged(self, payload, parse, tokens):
+        # If the call outlives the observed p95 latency, fire a second copy and
+        # take whichever succeeds first.
+        threshold = self.latency.percentile(95)
+        if threshold is None:
+            return self.send(payload, parse, tokens)
+        futures = [self.hedge_pool.submit(self.send, payload, parse, tokens)]
+        done, _ = wait(futures, timeout=threshold)
+        if not done:
+            futures.append(self.hedge_pool.submit(self.send, payload, parse, tokens))
+        while futures:
+            done, pending = wait(futures, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    return future.result()
+                error = future.exception()
+            futures = list(pending)
+        raise error
+
+    async def asend_hedged(self, payload, session, parse, tokens):
+        threshold = self.latency.percentile(95)
+        if threshold is None:
+            return await self.asend(payload, session, parse, tokens)
+        tasks = [asyncio.ensure_future(self.asend(payload, session, parse, tokens))]
+        done, _ = await asyncio.wait(tasks, timeout=threshold)
+        if not done:
+            tasks.append(asyncio.ensure_future(self.asend(payload, session, parse, tokens)))
+        try:
+            while tasks:
+                done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        return task.result()
+                    error = task.exception()
+                tasks = list(pending)
+            raise error
+        finally:
+            for task in tasks:
+                task.cancel()
+
+    def handle_failure(self, error, attempt):
+        # Returns the backoff to sleep before the next attempt, or None to give up
+        status = getattr(error, "status", None)
+        if not isinstance(error, ResponseParseError) and status != 429 and self.retry_policy.should_retry(status):
+            self.circuit_breaker.record_failure()  # outages and 5xx, not quota or bad answers
+        print(f"API call failed on attempt {attempt+1}/{self.retries}: {str(error)}")
+        if not self.retry_policy.should_retry(status):
+            print(f"Not retrying after status {status}.")
+            get_telemetry().count("requests_failed_total", provider=self.provider)
+            return None
+        if attempt + 1 == self.retries:
+            print(f"Skipping this image after {self.retries} failed attempts.")
+            get_telemetry().count("requests_failed_total", provider=self.provider)
+            return None
+        get_telemetry().count("retries_total", provider=self.provider)
+        return 0.0 if status == 429 else self.retry_policy.backoff(attempt)  # 429s wait in the rate limiter
+
+    def post(self, payload, parse=None):
+        parse = parse or self.parse_response
+        tokens = estimate_tokens(payload)
+
+        for attempt in range(self.retries):
+            permit = self.circuit_breaker.allow()
+            if not permit:
+                print(f"Circuit open for {self.provider}, skipping this request.")
+                get_telemetry().count("circuit_open_total", provider=self.provider)
+                return None
+            try:
+                if self.hedge:
+                    result = self.send_hedged(payload, parse, tokens)
+                else:
+                    result = self.send(payload, parse, tokens)
+                self.circuit_breaker.record_success()
+                return result
+            except RateLimiterError:
+                raise  # not an API failure, retrying cannot fix it
+            except Exception as e:
+                delay = self.handle_failure(e, attempt)
+                if delay is None:
+                    return None  # Skip the current image
+            finally:
+                if permit == "trial":
+                    self.circuit_breaker.end_trial()
+            time.sleep(delay)
+
+    async def apost(self, payload, session, parse=None):
+        # Same as post, on a shared aiohttp.ClientSession
+        parse = parse or self.parse_response
+        tokens = estimate_tokens(payload)
+
+        for attempt in range(self.retries):
+            permit = self.circuit_breaker.allow()
+            if not permit:
+                print(f"Circuit open for {self.provider}, skipping this request.")
+                get_telemetry().count("circuit_open_total", provider=self.provider)
+                return None
+            try:
+                if self.hedge:
+                    result = await self.asend_hedged(payload, session, parse, tokens)
+                else:
+                    result = await self.asend(payload, session, parse, tokens)
+                self.circuit_breaker.record_success()
+                return result
+            except RateLimiterError:
+                raise  # not an API failure, retrying cannot fix it
+            except Exception as e:
+                delay = self.handle_failure(e, attempt)
+                if delay is None:
+                    return None
+            finally:
+                # also runs on cancellation, so a trial can never stay pending
+                if permit == "trial":
+                    self.circuit_breaker.end_trial()
+            await asyncio.sleep(delay)
@@ -0,0 +1,211 @@
+import os
+import json
+import time
+import uuid
+import shutil
+
+from .transport import get_transport
+
+
+# Terminal job states, normalised across providers
+DONE, FAILED = "completed", "failed"
+
+
+def write_batch_file(api, requests, path):
+    # requests: [(custom_id, payload)] built with the client's own
+    # build_payload / build_batch_payload, one line per request in the
+    # provider's batch input format.
+    if os.path.dirname(path):
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as file:
+        for custom_id, payload in requests:
+            if api.provider == "openai":
+                line = {"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": payload}
+            else:
+                line = {"key": custom_id, "request": payload}
+            file.write(json.dumps(line) + "\n")
+    return path
+
+
+def read_batch_results(path):
+    # {custom_id: (response body or None, error or None)} from either
+    # provider's result file
+    results = {}
+    with open(path) as file:
+        for line in file:
+            if not line.strip():
+                continue
+            record = json.loads(line)
+            if "custom_id" in record:
+                response = record.get("response") or {}
+                if record.get("error") or response.get("status_code", 200) != 200:
+                    results[record["custom_id"]] = (None, record.get("error") or response.get("body"))
+                else:
+                    results[record["custom_id"]] = (response.get("body"), None)
+            else:
+                results[record["key"]] = (record.get("response"), record.get("error"))
+    return results
+
+
+class OpenAIBatchBackend:
+    # Files + Batches API: upload the JSONL, create a 24h batch on
+    # /v1/chat/completions, poll it, download the output file.
+    def __init__(self, api, base_url=None, completion_window="24h"):
+        self.api = api
+        self.base_url = base_url or "https://api.openai.com"
+        self.completion_window = completion_window
+        self.session = get_transport().session
+        self.headers = {"Authorization": f"Bearer {api.api_key}"}
+
+    def request(self, method, path, **kwargs):
+        response = self.session.request(method, f"{self.base_url}{path}", headers=self.headers, timeout=300, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def submit(self, input_path):
+        with open(input_path, "rb") as file:
+            uploaded = self.request("POST", "/v1/files", data={"purpose": "batch"},
+                                    files={"file": (os.path.basename(input_path), file)}).json()
+        batch = self.request("POST", "/v1/batches", json={"input_file_id": uploaded["id"],
+                                                          "endpoint": "/v1/chat/completions",
+                                                          "completion_window": self.completion_window}).json()
+        return batch["id"]
+
+    def status(self, job_id):
+        batch = self.request("GET", f"/v1/batches/{job_id}").json()
+        if batch["status"] == "completed":
+            return DONE, batch
+        if batch["status"] in ("failed", "expired", "cancelled"):
+            return FAILED, batch
+        return batch["status"], batch
+
+    def download(self, job, output_path):
+        with open(output_path, "wb") as file:
+            for file_id in (job.get("output_file_id"), job.get("error_file_id")):
+                if file_id:
+                    file.write(self.request("GET", f"/v1/files/{file_id}/content").content)
+        return output_path
+
+
+class GeminiBatchBackend:
+    # Files API (resumable upload) + models/{model}:batchGenerateContent
+    def __init__(self, api, base_url=None):
+        self.api = api
+        self.base_url = base_url or "https://generativelanguage.googleapis.com"
+        self.session = get_transport().session
+        self.params = {"key": api.api_key}
+
+    def request(self, method, url, **kwargs):
+        response = self.session.request(method, url, params=self.params, timeout=300, **kwargs)
+        response.raise_for_status()
+        return response
+
+    def submit(self, input_path):
+        size = os.path.getsize(input_path)
+        start = self.request("POST", f"{self.base_url}/upload/v1beta/files",
+                             headers={"X-Goog-Upload-Protocol": "resumable", "X-Goog-Upload-Command": "start",
+                                      "X-Goog-Upload-Header-Content-Length": str(size),
+                                      "X-Goog-Upload-Header-Content-Type": "application/jsonl",
+                                      "Content-Type": "application/json"},
+                             json={"file": {"display_name": os.path.basename(input_path)}})
+        with open(input_path, "rb") as file:
+            uploaded = self.session.post(start.headers["X-Goog-Upload-URL"], data=file, timeout=300,
+                                         headers={"X-Goog-Upload-Offset": "0",
+                                                  "X-Goog-Upload-Command": "upload, finalize"})
+        uploaded.raise_for_status()
+
+        batch = self.request("POST", f"{self.base_url}/v1beta/models/{self.api.model}:batchGenerateContent",
+                             json={"batch": {"display_name": os.path.basename(input_path),
+                                             "input_config": {"file_name": uploaded.json()["file"]["name"]}}}).json()
+        return batch["name"]
+
+    def status(self, job_id):
+        job = self.request("GET", f"{self.base_url}/v1beta/{job_id}").json()
+        state = job.get("metadata", {}).get("state", "")
+        if state == "BATCH_STATE_SUCCEEDED" or (job.get("done") and "error" not in job):
+            return DONE, job
+        if state in ("BATCH_STATE_FAILED", "BATCH_STATE_CANCELLED", "BATCH_STATE_EXPIRED") or "error" in job:
+            return FAILED, job
+        return state or "pending", job
+
+    def download(self, job, output_path):
+        output = job.get("response") or job.get("metadata", {}).get("output", {})
+        file_name = output.get("responsesFile")
+        content = self.request("GET", f"{self.base_url}/download/v1beta/{file_name}:download",
+                               params={**self.params, "alt": "media"}).content
+        with open(output_path, "wb") as file:
+            file.write(content)
+        return output_path
+
+
+class LocalBatchBackend:
+    # File-based stand-in for testing: the job is a directory under job_dir,
+    # and the first poll sends every line to the client's normal endpoint
+    # (e.g. api/mock_server.py) and writes the result file in the
+    # provider's own output format.
+    def __init__(self, api, job_dir):
+        self.api = api
+        self.job_dir = job_dir
+
+    def submit(self, input_path):
+        job_id = f"local-{uuid.uuid4().hex[:12]}"
+        os.makedirs(os.path.join(self.job_dir, job_id))
+        shutil.copy(input_path, os.path.join(self.job_dir, job_id, "input.jsonl"))
+        return job_id
+
+    def status(self, job_id):
+        path = os.path.join(self.job_dir, job_id)
+        output_path = os.path.join(path, "output.jsonl")
+        if not os.path.exists(output_path):
+            self.run(os.path.join(path, "input.jsonl"), output_path)
+        return DONE, {"id": job_id, "output": output_path}
+
+    def run(self, input_path, output_path):
+        transport = get_transport()
+        with open(input_path) as source, open(output_path + ".tmp", "w") as sink:
+            for line in source:
+                record = json.loads(line)
+                openai = "custom_id" in record
+                payload = record["body"] if openai else record["request"]
+                try:
+                    response = transport.post(self.api.request_url(), self.api.headers, payload)
+                    status = response.status_code
+                    body = response.json() if status == 200 else None
+                    error = None if body is not None else {"code": status, "message": response.text}
+                except Exception as e:
+                    status, body, error = 500, None, {"code": 500, "message": str(e)}
+                if openai:
+                    result = {"id": f"batch_req_{uuid.uuid4().hex[:12]}", "custom_id": record["custom_id"],
+                              "response": {"status_code": status, "body": body or error},
+                              "error": None}
+                else:
+                    result = {"key": record["key"], "response": body} if body is not None else \
+                             {"key": record["key"], "error": error}
+                sink.write(json.dumps(result) + "\n")
+        os.replace(output_path + ".tmp", output_path)
+
+    def download(self, job, output_path):
+        shutil.copy(job["output"], output_path)
+        return output_path
+
+
+def get_batch_backend(api, backend="provider", job_dir="./batch/jobs", base_url=None, completion_window="24h"):
+    if backend == "local":
+        return LocalBatchBackend(api, job_dir)
+    if api.provider == "openai":
+        return OpenAIBatchBackend(api, base_url, completion_window)
+    if api.provider == "gemini":
+        return GeminiBatchBackend(api, base_url)
+    raise ValueError(f"No batch backend for provider: {api.provider}")
+
+
+def wait_for_job(backend, job_id, poll_interval=60, timeout=None):
+    start = time.monotonic()
+    while True:
+        state, job = backend.status(job_id)
+        if state in (DONE, FAILED):
+            return state, job
+        if timeout is not None and time.monotonic() - start > timeout:
+            return state, job
+        print(f"Batch job {job_id}: {state}, checking again in {poll_interval}s")
+        time.sleep(poll_interval)
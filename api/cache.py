@@ -0,0 +1,111 @@
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import threading
+
+from telemetry import get_telemetry
+
+
+def _sha256(text):
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def cache_key(endpoint, model, inputs, example_pairs):
+    # Content address of a request: endpoint (without the API key), model,
+    # prompt text, and hashes of the base64 image payload(s) and of the
+    # few-shot examples. The endpoint keeps answers from a mock or proxy
+    # server apart from the provider's.
+    image = inputs["image"] if "image" in inputs else "\n".join(inputs["images"])
+    parts = {
+        "endpoint": endpoint,
+        "model": model,
+        "prompt": inputs["prompt"],
+        "image": _sha256(image),
+        "examples": _sha256(json.dumps(example_pairs, sort_keys=True)),
+    }
+    return _sha256(json.dumps(parts, sort_keys=True))
+
+
+class ResponseCache:
+    # Single-file SQLite store of VLM responses with size-based LRU eviction.
+    def __init__(self, path, max_bytes=512 * 1024 ** 2):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.conn = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS responses ("
+            "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_access REAL NOT NULL)"
+        )
+        self.conn.execute("CREATE INDEX IF NOT EXISTS responses_last_access ON responses (last_access)")
+        # Running byte total (key plus value of every row), so a put does not
+        # have to sum the whole table; created from the table on first use.
+        if self.conn.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'cache_meta'").fetchone() is None:
+            self.conn.execute("UPDATE responses SET size = length(key) + length(value)")
+            self.conn.execute("CREATE TABLE cache_meta (id INTEGER PRIMARY KEY CHECK (id = 0), total_bytes INTEGER NOT NULL)")
+            self.conn.execute("INSERT INTO cache_meta VALUES (0, (SELECT COALESCE(SUM(size), 0) FROM responses))")
+        self.conn.commit()
+
+    def get(self, key):
+        with self.lock:
+            row = self.conn.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                self.misses += 1
+                get_telemetry().count("cache_requests_total", result="miss")
+                return None
+            self.hits += 1
+            get_telemetry().count("cache_requests_total", result="hit")
+            self.conn.execute("UPDATE responses SET last_access = ? WHERE key = ?", (time.time(), key))
+            self.conn.commit()
+            return json.loads(row[0])
+
+    def put(self, key, value):
+        value = json.dumps(value)
+        size = len(key) + len(value)
+        with self.lock:
+            # one write transaction, so other processes sharing the file see a consistent total
+            self.conn.execute("BEGIN IMMEDIATE")
+            row = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_access) VALUES (?, ?, ?, ?)",
+                (key, value, size, time.time()),
+            )
+            self.conn.execute("UPDATE cache_meta SET total_bytes = total_bytes + ? WHERE id = 0",
+                              (size - (row[0] if row else 0),))
+            self.evict()
+            self.conn.commit()
+
+    def evict(self):
+        total = self.conn.execute("SELECT total_bytes FROM cache_meta WHERE id = 0").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        stale, freed = [], 0
+        for key, size in self.conn.execute("SELECT key, size FROM responses ORDER BY last_access"):
+            if total - freed <= self.max_bytes:
+                break
+            stale.append((key,))
+            freed += size
+        self.conn.executemany("DELETE FROM responses WHERE key = ?", stale)
+        self.conn.execute("UPDATE cache_meta SET total_bytes = total_bytes - ? WHERE id = 0", (freed,))
+
+    def stats(self):
+        with self.lock:
+            entries = self.conn.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+            size = self.conn.execute("SELECT total_bytes FROM cache_meta WHERE id = 0").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries, "bytes": size}
+
+
+_caches = {}
+
+def get_response_cache(path, max_bytes=512 * 1024 ** 2):
+    if path is None:
+        return None
+    if path not in _caches:
+        _caches[path] = ResponseCache(path, max_bytes)
+    return _caches[path]
@@ -1,40 +1,31 @@
-import time
-import requests
 import ast
 
-class RateLimiter:
-    def __init__(self, max_requests, time_window):
-        self.max_requests = max_requests
-        self.time_window = time_window
-        self.requests = 0
+from ..base import BaseAPI
 
-    def wait(self):
-        if self.requests >= self.max_requests:
-            time.sleep(self.time_window)
-            self.requests = 0
-        self.requests += 1
 
-class GeminiAPI:
-    def __init__(self, api_key, model, retries=10, delay=5):
-        self.api_key = api_key
-        self.model = model
-        self.url = f"https://generativelanguage.googleapis.com/v1beta/models/{model}:generateContent"
+class GeminiAPI(BaseAPI):
+    provider = "gemini"
+
+    def __init__(self, api_key, model, retries=10, delay=5, requests_per_minute=150, tokens_per_minute=None, cache=None, resilience=None,
+                 base_url=None, rate_limit_dir=None):
+        super().__init__(api_key, model, retries, delay, requests_per_minute, tokens_per_minute, cache, resilience,
+                         rate_limit_dir)
+        self.url = f"{base_url or 'https://generativelanguage.googleapis.com'}/v1beta/models/{model}:generateContent"
         self.headers = {
             "Content-Type": "application/json",
         }
-        self.rate_limiter = RateLimiter(max_requests=15, time_window=5)  # Adjust as needed
-        self.retries = retries
-        self.delay = delay
 
-    def get_shape_information(self, inputs: dict, example_pairs) -> str:
-        self.rate_limiter.wait()
+    def request_url(self):
+        return f"{self.url}?key={self.api_key}"
 
+    def build_payload(self, inputs: dict, example_pairs) -> dict:
+        mime_type = inputs.get('mime_type', "image/jpeg")
         examples = []
         
         examples.extend([{"text": inputs['prompt']}])
         for shape, img_crop_list in example_pairs.items():
             for crop in img_crop_list:
-                examples.append([{"inline_data": {"mime_type": "image/jpeg", "data":crop}}])
+                examples.append({"inline_data": {"mime_type": mime_type, "data": crop}})
                 examples.append({"text": f'{{"Intended classification output below: "}}' })
                 examples.append({"text": f'{shape}' })
         
@@ -42,7 +33,7 @@ class GeminiAPI:
             {"text": inputs['prompt']},
             {
                 "inline_data": {
-                    "mime_type": "image/jpeg", 
+                    "mime_type": mime_type, 
                     "data": inputs['image']
                 }
             }
@@ -60,32 +51,29 @@ class GeminiAPI:
                 "response_mime_type": "application/json",
             }
         }
+        return payload
+
+    def build_batch_payload(self, inputs: dict, example_pairs) -> dict:
+        mime_type = inputs.get('mime_type', "image/jpeg")
+        payload = self.build_payload({"prompt": inputs['prompt'], "image": inputs['images'][0], "mime_type": mime_type},
+                                     example_pairs)
+        parts = payload["contents"][0]["parts"][:-1]
+        for i, image in enumerate(inputs['images']):
+            parts.append({"text": f"Patch {i+1}:"})
+            parts.append({"inline_data": {"mime_type": mime_type, "data": image}})
+        payload["contents"][0]["parts"] = parts
+        return payload
 
-        # Retry mechanism
-        attempt = 0
-        while attempt < self.retries:
-            try:
-                response = requests.post(f"{self.url}?key={self.api_key}", headers=self.headers, json=payload)
-                if response.status_code == 200:
-                    result = response.json()
-                    if "candidates" in result and result["candidates"]:
-                        text = ast.literal_eval(result["candidates"][0]['content']['parts'][0]['text'])
-                        if "Classification" in text.keys():
-                            return text["Classification"]
-                        if "classification" in text.keys():
-                            return text["classification"]
-                        return 'None'
-                    
-                    else:
-                        raise Exception(f"Unexpected API response format: {result}")
-                else:
-                    raise Exception(f"Failed to call the API: {response.status_code} - {response.text}")
+    def extract_text(self, result: dict) -> str:
+        if "candidates" in result and result["candidates"]:
+            return result["candidates"][0]['content']['parts'][0]['text']
+        else:
+            raise Exception(f"Unexpected API response format: {result}")
 
-            except Exception as e:
-                print(f"API call failed on attempt {attempt+1}/{self.retries}: {str(e)}")
-                if attempt + 1 == self.retries:
-                    print(f"Skipping this image after {self.retries} failed attempts.")
-                    return None  # Skip the current image
-                else:
-                    time.sleep(self.delay)  # Delay before retrying
-                    attempt += 1
\ No newline at end of file
+    def parse_response(self, result: dict) -> str:
+        text = ast.literal_eval(self.extract_text(result))
+        if "Classification" in text.keys():
+            return text["Classification"]
+        if "classification" in text.keys():
+            return text["classification"]
+        return 'None'
@@ -1,38 +1,24 @@
-import time
-import requests
-import ast
+from ..base import BaseAPI
 
-class RateLimiter:
-    def __init__(self, max_requests, time_window):
-        self.max_requests = max_requests
-        self.time_window = time_window
-        self.requests = 0
 
-    def wait(self):
-        if self.requests >= self.max_requests:
-            time.sleep(self.time_window)
-            self.requests = 0
-        self.requests += 1
+class GPTAPI(BaseAPI):
+    provider = "openai"
 
-class GPTAPI:
-    def __init__(self, api_key, model, retries=10, delay=5):
-        self.api_key = api_key
-        self.model = model
-        self.url = "https://api.openai.com/v1/chat/completions"
+    def __init__(self, api_key, model, retries=10, delay=5, requests_per_minute=500, tokens_per_minute=None, cache=None, resilience=None,
+                 base_url=None, rate_limit_dir=None):
+        super().__init__(api_key, model, retries, delay, requests_per_minute, tokens_per_minute, cache, resilience,
+                         rate_limit_dir)
+        self.url = f"{base_url or 'https://api.openai.com'}/v1/chat/completions"
         self.headers = {
             "Content-Type": "application/json",
             "Authorization": f"Bearer {self.api_key}"
         }
-        self.rate_limiter = RateLimiter(max_requests=20, time_window=1)
-        self.retries = retries
-        self.delay = delay
-
-    def get_shape_information(self, inputs: dict, example_pairs: list) -> str:
-        self.rate_limiter.wait()
 
+    def build_payload(self, inputs: dict, example_pairs: list) -> dict:
+        mime_type = inputs.get('mime_type', "image/jpeg")
         examples = []
         for pair in example_pairs:
-            examples.append({"type": "image_url", "image_url": {"url": f"data:image/jpeg;base64,{pair[0]}", "detail": "high"}})
+            examples.append({"type": "image_url", "image_url": {"url": f"data:{mime_type};base64,{pair[0]}", "detail": "high"}})
             examples.append({"type": "text", "text": f'{{"Intended object detection output below: "}}' })
             examples.append({"type": "text", "text": f'{pair[1]}' })
 
@@ -48,7 +34,7 @@ class GPTAPI:
                         {
                             "type": "image_url",
                             "image_url": {
-                                "url": f"data:image/jpeg;base64,{inputs['image']}",
+                                "url": f"data:{mime_type};base64,{inputs['image']}",
                                 "detail": "high"
                             }
                         }
@@ -56,26 +42,10 @@ class GPTAPI:
                 }
             ]
         }
+        return payload
 
-        # Retry mechanism
-        attempt = 0
-        while attempt < self.retries:
-            try:
-                response = requests.post(self.url, headers=self.headers, json=payload)
-                if response.status_code == 200:
-                    result = response.json()
-                    if "choices" in result and result["choices"]:
-                        return result["choices"][0]['message']['content']
-                    else:
-                        raise Exception(f"Unexpected API response format: {result}")
-                else:
-                    raise Exception(f"Failed to call the API: {response.status_code} - {response.text}")
-
-            except Exception as e:
-                print(f"API call failed on attempt {attempt+1}/{self.retries}: {str(e)}")
-                if attempt + 1 == self.retries:
-                    print(f"Skipping this image after {self.retries} failed attempts.")
-                    return None  # Skip the current image
-                else:
-                    time.sleep(self.delay)  # Delay before retrying
-                    attempt += 1
\ No newline at end of file
+    def parse_response(self, result: dict) -> str:
+        if "choices" in result and result["choices"]:
+            return result["choices"][0]['message']['content']
+        else:
+            raise Exception(f"Unexpected API response format: {result}")
@@ -0,0 +1,172 @@
+import re
+import json
+import time
+import random
+import hashlib
+import argparse
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+LABELS = ["Round", "Spindle", "Polygonal", "None"]
+
+
+def label_for(image):
+    # Deterministic answer: the same patch always gets the same label
+    return LABELS[int(hashlib.sha256(image.encode("utf-8")).hexdigest(), 16) % len(LABELS)]
+
+
+class mock_settings():
+    def __init__(self, latency="constant", latency_ms=200.0, latency_spread=0.5, rate_429=0.0, rate_5xx=0.0,
+                 retry_after=1.0, seed=0):
+        self.latency = latency
+        self.latency_ms = latency_ms
+        self.latency_spread = latency_spread
+        self.rate_429 = rate_429
+        self.rate_5xx = rate_5xx
+        self.retry_after = retry_after
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "400": 0, "429": 0, "5xx": 0, "images": 0}
+
+    def sample_latency(self):
+        with self.lock:
+            if self.latency == "uniform":
+                low = self.latency_ms * (1 - self.latency_spread)
+                return self.rng.uniform(low, self.latency_ms * (1 + self.latency_spread)) / 1000.0
+            if self.latency == "lognormal":
+                return self.rng.lognormvariate(0, self.latency_spread) * self.latency_ms / 1000.0
+            return self.latency_ms / 1000.0
+
+    def sample_error(self):
+        with self.lock:
+            draw = self.rng.random()
+            if draw < self.rate_429:
+                return 429
+            if draw < self.rate_429 + self.rate_5xx:
+                return 503
+            return None
+
+
+def parse_parts(body):
+    # Flattens either request shape into [("text", str) | ("image", base64)].
+    # Raises ValueError for a part the real endpoint would reject with a 400.
+    parts = []
+    if "messages" in body:
+        for item in body["messages"][0]["content"]:
+            if not isinstance(item, dict) or item.get("type") not in ("text", "image_url"):
+                raise ValueError(f"Invalid content part: {str(item)[:80]}")
+            if item["type"] == "text":
+                parts.append(("text", item["text"]))
+            else:
+                parts.append(("image", item["image_url"]["url"].split(",", 1)[-1]))
+    else:
+        for item in body["contents"][0]["parts"]:
+            if not isinstance(item, dict):
+                raise ValueError("Invalid JSON payload received. Proto field is not repeating, cannot start list.")
+            if "text" in item:
+                parts.append(("text", item["text"]))
+            elif isinstance(item.get("inline_data"), dict) and "data" in item["inline_data"]:
+                parts.append(("image", item["inline_data"]["data"]))
+            else:
+                raise ValueError(f"Invalid part: {str(item)[:80]}")
+    return parts
+
+
+def answer(parts, gemini):
+    texts = [text for kind, text in parts if kind == "text"]
+    images = [data for kind, data in parts if kind == "image"]
+    patches = sum(1 for text in texts if re.match(r"Patch \d+:", text))
+
+    if any("bounding boxes" in text for text in texts):
+        return json.dumps({"Round": [], "Spindle": [], "Polygonal": []})
+    if patches:
+        return json.dumps([label_for(image) for image in images[-patches:]])
+    label = label_for(images[-1]) if images else "None"
+    return json.dumps({"Classification": label}) if gemini else label
+
+
+def make_handler(settings):
+    class handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def send_json(self, status, body, headers=None):
+            data = json.dumps(body).encode("utf-8")
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            for key, value in (headers or {}).items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path == "/stats":
+                with settings.lock:
+                    return self.send_json(200, dict(settings.stats))
+            self.send_json(404, {"error": "not found"})
+
+        def do_POST(self):
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            gemini = ":generateContent" in self.path
+            if not gemini and not self.path.startswith("/v1/chat/completions"):
+                return self.send_json(404, {"error": "not found"})
+
+            time.sleep(settings.sample_latency())
+            try:
+                parts = parse_parts(body)
+            except (KeyError, IndexError, TypeError, ValueError) as e:
+                with settings.lock:
+                    settings.stats["requests"] += 1
+                    settings.stats["400"] += 1
+                return self.send_json(400, {"error": {"code": 400, "message": str(e), "status": "INVALID_ARGUMENT"}})
+            error = settings.sample_error()
+            with settings.lock:
+                settings.stats["requests"] += 1
+                settings.stats["images"] += sum(1 for kind, _ in parts if kind == "image")
+                if error == 429:
+                    settings.stats["429"] += 1
+                elif error:
+                    settings.stats["5xx"] += 1
+
+            if error == 429:
+                return self.send_json(429, {"error": "rate limited"}, {"Retry-After": str(settings.retry_after)})
+            if error:
+                return self.send_json(error, {"error": "unavailable"})
+
+            text = answer(parts, gemini)
+            if gemini:
+                self.send_json(200, {"candidates": [{"content": {"parts": [{"text": text}]}}]})
+            else:
+                self.send_json(200, {"choices": [{"message": {"content": text}}]})
+
+    return handler
+
+
+def serve(host="127.0.0.1", port=8000, settings=None):
+    # Local stand-in for the OpenAI chat/completions and Gemini generateContent
+    # endpoints. Point pipeline.api_base_urls at http://host:port to use it.
+    server = ThreadingHTTPServer((host, port), make_handler(settings or mock_settings()))
+    server.daemon_threads = True
+    return server
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Mock VLM server for offline throughput testing.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8000)
+    parser.add_argument("--latency", choices=["constant", "uniform", "lognormal"], default="constant")
+    parser.add_argument("--latency-ms", type=float, default=200.0)
+    parser.add_argument("--latency-spread", type=float, default=0.5)
+    parser.add_argument("--rate-429", type=float, default=0.0)
+    parser.add_argument("--rate-5xx", type=float, default=0.0)
+    parser.add_argument("--retry-after", type=float, default=1.0)
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    settings = mock_settings(args.latency, args.latency_ms, args.latency_spread, args.rate_429, args.rate_5xx,
+                             args.retry_after, args.seed)
+    server = serve(args.host, args.port, settings)
+    print(f"Mock VLM server listening on http://{args.host}:{args.port}")
+    server.serve_forever()
@@ -0,0 +1,132 @@
+import os
+import json
+import time
+import fcntl
+import asyncio
+import hashlib
+import tempfile
+import threading
+from email.utils import parsedate_to_datetime
+
+
+class RateLimiterError(RuntimeError):
+    # The shared bucket state could not be read or written. This is a local
+    # setup problem, so callers do not retry it like a failed API call.
+    pass
+
+
+def get_limiter_name(provider, api_key, model):
+    # Quotas belong to a key (project) and model, so clients with different
+    # keys or models on one host get separate buckets.
+    digest = hashlib.sha256(f"{api_key}|{model}".encode("utf-8")).hexdigest()[:16]
+    return f"{provider}_{digest}"
+
+
+class RateLimiter:
+    # Token bucket over requests/min and (optionally) tokens/min. The bucket
+    # state lives in a small JSON file guarded by flock, so every thread and
+    # worker process using the same name draws from one budget.
+    def __init__(self, name, requests_per_minute, tokens_per_minute=None, state_dir=None):
+        self.name = name
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        state_dir = state_dir or tempfile.gettempdir()
+        os.makedirs(state_dir, exist_ok=True)
+        self.path = os.path.join(state_dir, f"vlm_rate_limit_{name}.json")
+        self.lock = threading.Lock()
+
+    def _update(self, fn):
+        try:
+            with self.lock, open(self.path, "a+") as file:
+                fcntl.flock(file, fcntl.LOCK_EX)
+                file.seek(0)
+                raw = file.read()
+                state = json.loads(raw) if raw else {}
+                result = fn(state, time.time())
+                file.seek(0)
+                file.truncate()
+                json.dump(state, file)
+                file.flush()
+                return result
+        except OSError as e:
+            raise RateLimiterError(f"Rate limiter state {self.path} is not usable: {e}") from e
+
+    @staticmethod
+    def _take(state, key, amount, per_minute, now):
+        # Refill, then take `amount` even if it drives the level negative; the
+        # debt is the time the caller has to wait for its reservation.
+        rate = per_minute / 60.0
+        level = state.get(key, per_minute)
+        elapsed = max(0.0, now - state.get("updated", now))
+        level = min(per_minute, level + elapsed * rate)
+        level -= min(amount, per_minute)
+        state[key] = level
+        return -level / rate if level < 0 else 0.0
+
+    def reserve(self, tokens=0):
+        def reserve_slot(state, now):
+            delay = self._take(state, "requests", 1, self.requests_per_minute, now)
+            if self.tokens_per_minute and tokens:
+                delay = max(delay, self._take(state, "tokens", tokens, self.tokens_per_minute, now))
+            state["updated"] = now
+            return max(delay, state.get("blocked_until", 0.0) - now)
+
+        return self._update(reserve_slot)
+
+    def wait(self, tokens=0):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            time.sleep(delay)
+        return max(delay, 0.0)
+
+    async def async_wait(self, tokens=0):
+        delay = self.reserve(tokens)
+        if delay > 0:
+            await asyncio.sleep(delay)
+        return max(delay, 0.0)
+
+    def penalize(self, retry_after):
+        # Called on 429: nobody sharing this bucket sends before retry_after
+        # has passed, and the request bucket restarts empty.
+        def block(state, now):
+            self._take(state, "requests", 0, self.requests_per_minute, now)
+            if self.tokens_per_minute:
+                self._take(state, "tokens", 0, self.tokens_per_minute, now)
+            state["requests"] = min(state["requests"], 0.0)
+            state["blocked_until"] = max(state.get("blocked_until", 0.0), now + retry_after)
+            state["updated"] = now
+
+        self._update(block)
+
+
+def parse_retry_after(headers, default=5.0):
+    if headers is None:
+        return default
+    value = headers.get("retry-after-ms")
+    if value is not None:
+        try:
+            return float(value) / 1000.0
+        except ValueError:
+            pass
+    value = headers.get("Retry-After")
+    if value is None:
+        return default
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return default
+
+
+_limiters = {}
+
+def get_rate_limiter(name, requests_per_minute, tokens_per_minute=None, state_dir=None):
+    key = (name, state_dir)
+    if key not in _limiters:
+        _limiters[key] = RateLimiter(name, requests_per_minute, tokens_per_minute, state_dir)
+    limiter = _limiters[key]
+    limiter.requests_per_minute = requests_per_minute
+    limiter.tokens_per_minute = tokens_per_minute
+    return limiter
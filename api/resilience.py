@@ -0,0 +1,104 @@
+import time
+import random
+import threading
+from collections import deque
+
+import numpy as np
+
+
+class APIError(Exception):
+    def __init__(self, status, message):
+        super().__init__(f"{status} - {message}")
+        self.status = status
+
+
+class ResponseParseError(Exception):
+    # A 200 whose body could not be parsed: retried, but not a provider failure
+    pass
+
+
+class RetryPolicy:
+    # Exponential backoff with full jitter. Network errors, 429 and 5xx are
+    # retried; any other 4xx fails fast since repeating it cannot succeed.
+    def __init__(self, retries=10, base_delay=1.0, max_delay=60.0, jitter=True,
+                 retry_statuses=(408, 409, 425, 429)):
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.jitter = jitter
+        self.retry_statuses = set(retry_statuses)
+
+    def should_retry(self, status):
+        return status is None or status >= 500 or status in self.retry_statuses
+
+    def backoff(self, attempt):
+        delay = min(self.max_delay, self.base_delay * 2 ** attempt)
+        return random.uniform(0, delay) if self.jitter else delay
+
+
+class CircuitBreaker:
+    # Opens after `failure_threshold` consecutive failures; while open, calls
+    # are refused until `reset_timeout` has passed, then one trial call is let
+    # through (half-open) and its outcome closes or re-opens the breaker.
+    def __init__(self, failure_threshold=5, reset_timeout=60.0):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at = None
+        self.trial = False
+        self.lock = threading.Lock()
+
+    def allow(self):
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if time.monotonic() - self.opened_at >= self.reset_timeout and not self.trial:
+                self.trial = True
+                return "trial"
+            return False
+
+    def end_trial(self):
+        # Called once the trial call is over. If its outcome resolved nothing
+        # (429, bad answer, 4xx, cancelled hedge) the breaker stays open but
+        # the next call after reset_timeout may try again.
+        with self.lock:
+            self.trial = False
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+            self.trial = False
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.trial or self.failures >= self.failure_threshold:
+                self.opened_at = time.monotonic()
+            self.trial = False
+
+
+class LatencyTracker:
+    # Rolling window of successful call latencies, used as the hedging trigger.
+    def __init__(self, window=200, min_samples=20):
+        self.samples = deque(maxlen=window)
+        self.min_samples = min_samples
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+
+    def percentile(self, q=95):
+        with self.lock:
+            if len(self.samples) < self.min_samples:
+                return None
+            return float(np.percentile(self.samples, q))
+
+
+_breakers = {}
+
+def get_circuit_breaker(name, failure_threshold=5, reset_timeout=60.0):
+    if name not in _breakers:
+        _breakers[name] = CircuitBreaker(failure_threshold, reset_timeout)
+    return _breakers[name]
@@ -0,0 +1,86 @@
+import json
+import gzip
+import asyncio
+from contextlib import asynccontextmanager
+
+import aiohttp
+import requests
+from requests.adapters import HTTPAdapter
+
+from telemetry import get_telemetry
+
+
+class HTTPTransport:
+    # One pooled keep-alive HTTP layer for every VLM client: a shared
+    # requests.Session for the blocking path and aiohttp sessions with the
+    # same limits and timeouts for the async path.
+    def __init__(self, pool_size=16, connect_timeout=10, read_timeout=120, gzip_requests=False):
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.read_timeout = read_timeout
+        self.gzip_requests = gzip_requests
+        # event loop -> [ClientSession, number of users]
+        self.loop_sessions = {}
+
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    def encode_body(self, payload, headers):
+        data = json.dumps(payload).encode("utf-8")
+        if self.gzip_requests:
+            data = gzip.compress(data, compresslevel=5)
+            headers = {**headers, "Content-Encoding": "gzip"}
+        get_telemetry().count("bytes_sent_total", len(data))
+        return data, headers
+
+    def post(self, url, headers, payload):
+        data, headers = self.encode_body(payload, headers)
+        return self.session.post(url, data=data, headers=headers,
+                                 timeout=(self.connect_timeout, self.read_timeout))
+
+    def async_session(self):
+        connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+        timeout = aiohttp.ClientTimeout(sock_connect=self.connect_timeout, sock_read=self.read_timeout)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    @asynccontextmanager
+    async def shared_async_session(self):
+        # One ClientSession per event loop: the first user opens it, later
+        # users on the same loop reuse its connections, and the last one to
+        # leave closes it.
+        loop = asyncio.get_running_loop()
+        entry = self.loop_sessions.get(loop)
+        if entry is None:
+            entry = self.loop_sessions[loop] = [self.async_session(), 0]
+        entry[1] += 1
+        try:
+            yield entry[0]
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                del self.loop_sessions[loop]
+                await entry[0].close()
+
+    def apost(self, session, url, headers, payload):
+        data, headers = self.encode_body(payload, headers)
+        return session.post(url, data=data, headers=headers)
+
+
+_transport = None
+
+def get_transport():
+    global _transport
+    if _transport is None:
+        _transport = HTTPTransport()
+    return _transport
+
+
+def configure_transport(pool_size=16, connect_timeout=10, read_timeout=120, gzip_requests=False):
+    global _transport
+    settings = (pool_size, connect_timeout, read_timeout, gzip_requests)
+    if _transport is None or settings != (_transport.pool_size, _transport.connect_timeout,
+                                          _transport.read_timeout, _transport.gzip_requests):
+        _transport = HTTPTransport(*settings)
+    return _transport
@@ -0,0 +1,306 @@
+import os
+import argparse
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+
+import cv2
+import numpy as np
+
+from config import pipeline
+from main import vlm_detection
+from metric import get_iou
+from region_classification import get_session
+from overlay import get_overlay_writer
+from journal import get_journal
+from telemetry import get_telemetry
+
+
+def parse_filename(filename, zoom_id):
+    parts = filename.rsplit("_", 1)
+    if len(parts) != 2 or not parts[1].startswith(zoom_id):
+        return None, None
+    experiment_id = parts[0]
+    zoom = parts[1]
+    return experiment_id, zoom
+
+
+def find_experiments(image_dir, label_dir, zoom_id):
+    # experiment id -> (image path, label path) for images with a matching label
+    filtered_images = {}
+    for img in os.listdir(image_dir):
+        experiment_id, zoom = parse_filename(img, zoom_id)
+        if img.endswith(".png") and experiment_id and zoom:
+            filtered_images[experiment_id] = os.path.join(image_dir, img)
+
+    filtered_labels = {}
+    for lbl in os.listdir(label_dir):
+        experiment_id, zoom = parse_filename(lbl, zoom_id)
+        if lbl.endswith(".txt") and experiment_id and zoom:
+            filtered_labels[experiment_id] = os.path.join(label_dir, lbl)
+
+    common_experiments = sorted(set(filtered_images.keys()) & set(filtered_labels.keys()))
+    return {experiment_id: (filtered_images[experiment_id], filtered_labels[experiment_id])
+            for experiment_id in common_experiments}
+
+
+# Settings of the batch, rebuilt in each worker by init_worker
+_worker_config = None
+
+
+def get_worker_settings(config):
+    # Plain copy of the config's settings: a config class pickles by name, so
+    # a worker would otherwise resolve it to its own unmodified module-level
+    # class and lose whatever the caller changed.
+    return {name: getattr(config, name) for name in dir(config) if not name.startswith("_")}
+
+
+def get_proposal_devices(config):
+    # GPUs the proposal workers are spread over, one worker each, so vit_h is
+    # loaded once per device rather than once per worker
+    if config.detector != "sam" or (config.sam_device is not None and not config.sam_device.startswith("cuda")):
+        return []
+    import torch
+    if config.sam_device not in (None, "cuda"):
+        return [config.sam_device]
+    return [f"cuda:{i}" for i in range(torch.cuda.device_count())]
+
+
+def init_worker(settings, devices=(), counter=None):
+    global _worker_config
+    _worker_config = type("worker_config", (), settings)
+    if devices:
+        with counter.get_lock():
+            index = counter.value
+            counter.value += 1
+        _worker_config.sam_device = devices[index % len(devices)]
+    if settings["torch_threads"]:
+        import torch
+        torch.set_num_threads(settings["torch_threads"])
+
+
+def get_worker_config():
+    return _worker_config
+
+
+# Proposal-only detection of this worker, built on first use
+_worker_detection = None
+
+
+def get_worker_detection():
+    # Workers only propose, so their detection has no journal, event log or
+    # profile; the parent owns those. Area statistics are loaded once here.
+    global _worker_detection
+    if _worker_detection is None:
+        config = type("worker_config", (_worker_config,), {
+            "journal_path": None, "telemetry": {**_worker_config.telemetry, "log_path": None, "profile_path": None}})
+        _worker_detection = vlm_detection(None, config)
+    return _worker_detection
+
+
+def get_worker_pool(config, workers):
+    devices = get_proposal_devices(config)
+    # Workers are spawned, not forked: the parent may already hold a CUDA
+    # context (e.g. from profile_first_image), which a forked child cannot
+    # use, and a fresh interpreter also starts with empty telemetry.
+    context = multiprocessing.get_context("spawn")
+    return ProcessPoolExecutor(workers, mp_context=context, initializer=init_worker,
+                               initargs=(get_worker_settings(config), devices, context.Value("i", 0)))
+
+
+def propose_image(experiment_id, img_path):
+    # Runs in a CPU worker: decode, generate proposals, and hand the decoded
+    # frame back through shared memory instead of pickling it.
+    telemetry = get_telemetry()
+    with telemetry.stage("read_image"):
+        image = cv2.imread(img_path)
+    bbox, priors = get_worker_detection().propose_with_priors(image)
+
+    shm = shared_memory.SharedMemory(create=True, size=image.nbytes)
+    np.ndarray(image.shape, dtype=image.dtype, buffer=shm.buf)[:] = image
+    shm.close()
+    # the parent attaches, tracks and unlinks the segment from here on
+    resource_tracker.unregister(shm._name, "shared_memory")
+    # the worker's timers travel back with the result and are merged by the parent
+    return (experiment_id, shm.name, image.shape, image.dtype.str, [list(map(int, box)) for box in bbox], priors,
+            telemetry.drain())
+
+
+class batch_runner():
+    def __init__(self, config, image_dir, label_dir, shots, zoom_id, output_dir="./results/",
+                 workers=None, max_images_in_flight=2):
+        self.config = config
+        self.shots = shots
+        self.zoom_id = zoom_id
+        self.output_dir = output_dir
+        self.workers = workers or max(1, (os.cpu_count() or 2) // 2)
+        devices = get_proposal_devices(config)
+        if devices and self.workers > len(devices):
+            print(f"Proposals run on {len(devices)} GPU worker(s) instead of {self.workers}")
+            self.workers = len(devices)
+        self.max_images_in_flight = max_images_in_flight
+        self.experiments = find_experiments(image_dir, label_dir, zoom_id)
+        self.session = get_session(config)
+        self.journal = get_journal(config.journal_path)
+        self.model = f"{config.vlm_model_type}:{config.vlm}"
+        # (image path, shot) -> shapes of the image profiled before the batch
+        self.profiled = {}
+
+    async def classify_image(self, experiment_id, image, bbox, priors=None):
+        img_path, label_path = self.experiments[experiment_id]
+        results = {}
+        for shot in self.shots:
+            shapes = self.get_finished(img_path, shot)
+            if shapes is not None:
+                results[shot] = get_iou(shapes, label_path, img_path)
+                continue
+
+            save_filename = os.path.join(self.output_dir, f"{experiment_id}_{self.zoom_id}_{shot}.png")
+            custom_config = {"shot": shot, "save_filename": save_filename}
+            pipeline_obj = vlm_detection(img_path, self.config, custom_config, self.session)
+            shapes = await pipeline_obj.aclassify(image, bbox, priors)
+
+            if self.config.plot:
+                with get_telemetry().stage("plot"):
+                    self.write_overlay(experiment_id, shot, image, shapes, save_filename)
+            results[shot] = get_iou(shapes, label_path, img_path)
+            print(f"IoU of {experiment_id} at shot {shot}: {results[shot]}")
+            get_telemetry().log("image", image=img_path, shot=shot, proposals=len(bbox), iou=results[shot])
+        return results
+
+    def write_overlay(self, experiment_id, shot, image, shapes, save_filename):
+        overlay = self.config.overlay
+        writer = get_overlay_writer(overlay["queue_size"])
+        canvas = writer.submit(image, shapes, save_filename, thickness=overlay["thickness"], labels=overlay["labels"])
+        if overlay["contact_sheet"]:
+            sheet_filename = os.path.join(self.output_dir, f"contact_sheet_shot_{shot}.jpg")
+            writer.add_to_sheet(sheet_filename, canvas, experiment_id, overlay["tile_size"])
+
+    def get_finished(self, img_path, shot):
+        if (img_path, shot) in self.profiled:
+            return self.profiled[(img_path, shot)]
+        if self.journal is None:
+            return None
+        return self.journal.get_image(img_path, shot, self.model)
+
+    async def classify_shared(self, experiment_id, shm_name, shape, dtype, bbox, priors, semaphore):
+        # Crops are taken as views of the worker's frame in shared memory.
+        async with semaphore:
+            shm = shared_memory.SharedMemory(name=shm_name)
+            try:
+                image = np.ndarray(shape, dtype=np.dtype(dtype), buffer=shm.buf)
+                results = await self.classify_image(experiment_id, image, bbox, priors)
+                del image
+            finally:
+                shm.close()
+                shm.unlink()
+        return experiment_id, results
+
+    async def process_image(self, pool, experiment_id, img_path, frames, semaphore):
+        # A frame slot is taken before the image goes to a worker and freed
+        # once its shared memory is unlinked, so only a bounded number of
+        # frames sit in /dev/shm however many images are pending.
+        async with frames:
+            proposal = await asyncio.get_running_loop().run_in_executor(pool, propose_image, experiment_id, img_path)
+            experiment_id, shm_name, shape, dtype, bbox, priors, worker_telemetry = proposal
+            get_telemetry().merge(worker_telemetry)
+            print(f"Proposals ready for {experiment_id}: {len(bbox)} boxes")
+            return await self.classify_shared(experiment_id, shm_name, shape, dtype, bbox, priors, semaphore)
+
+    async def arun(self):
+        semaphore = asyncio.Semaphore(self.max_images_in_flight)
+        ious = {shot: {} for shot in self.shots}
+
+        # images finished for every shot in an earlier run are scored from the journal
+        pending = {}
+        for experiment_id, (img_path, label_path) in self.experiments.items():
+            finished = {shot: self.get_finished(img_path, shot) for shot in self.shots}
+            if all(shapes is not None for shapes in finished.values()):
+                for shot, shapes in finished.items():
+                    ious[shot][experiment_id] = get_iou(shapes, label_path, img_path)
+                print(f"Skipping {experiment_id}: already finished")
+            else:
+                pending[experiment_id] = img_path
+
+        # every image and shot of the run reuses one HTTP session and its connections
+        async with self.session.api.transport.shared_async_session():
+            with get_worker_pool(self.config, self.workers) as pool:
+                # classification of finished images overlaps with proposals still
+                # running; workers only get a new image when a frame slot is free
+                frames = asyncio.Semaphore(self.max_images_in_flight + self.workers)
+                classifications = [self.process_image(pool, experiment_id, img_path, frames, semaphore)
+                                   for experiment_id, img_path in pending.items()]
+                for experiment_id, results in await asyncio.gather(*classifications):
+                    for shot, iou in results.items():
+                        ious[shot][experiment_id] = iou
+
+        return ious
+
+    def write_reports(self, ious):
+        os.makedirs(self.output_dir, exist_ok=True)
+        for shot in self.shots:
+            output_file_path = os.path.join(self.output_dir, f"shot_{shot}_iou_results.txt")
+            with open(output_file_path, "w") as output_file:
+                average_iou = 0
+                output_file.write(f"Results for Shot {shot}:\n")
+                for experiment_id in self.experiments:
+                    if experiment_id not in ious[shot]:
+                        continue
+                    iou = ious[shot][experiment_id]
+                    output_file.write(f"Experiment ID: {experiment_id}, IoU: {iou:.4f}\n")
+                    average_iou += (iou / len(ious[shot]))
+
+                print(f"Average IoU for Shot {shot}: {average_iou}")
+                output_file.write(f"\nAverage IoU for Shot {shot}: {average_iou:.4f}\n")
+
+            print(f"IoU results for Shot {shot} saved to {output_file_path}")
+
+    def profile_first_image(self):
+        # One image end to end in this process, outside the worker pool, so the
+        # profile is not interleaved with other images. Its result counts as
+        # finished for that shot, so the batch does not classify it again.
+        experiment_id, (img_path, _) = next(iter(self.experiments.items()))
+        shot = self.shots[0]
+        save_filename = os.path.join(self.output_dir, f"{experiment_id}_{self.zoom_id}_{shot}.png")
+        custom_config = {"shot": shot, "save_filename": save_filename}
+        self.profiled[(img_path, shot)] = vlm_detection(img_path, self.config, custom_config, self.session).process()
+        print(f"Profile of {experiment_id} saved to {self.config.telemetry['profile_path']}")
+
+    def run(self):
+        if self.config.telemetry.get("profile_path") and self.experiments:
+            self.profile_first_image()
+        ious = asyncio.run(self.arun())
+        self.write_reports(ious)
+        if self.session.cache is not None:
+            print(f"Response cache: {self.session.cache.stats()}")
+        if self.config.plot:
+            writer = get_overlay_writer(self.config.overlay["queue_size"])
+            writer.write_sheets(self.config.overlay["sheet_columns"], self.config.overlay["tile_size"])
+            writer.flush()
+        get_telemetry().write(self.config)
+        return ious
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run the detection pipeline over a folder of experiments.")
+    parser.add_argument("--image-dir", default="dataset/images/train")
+    parser.add_argument("--label-dir", default="dataset/labels/train")
+    parser.add_argument("--shots", type=int, nargs="+", default=[0, 6, 12, 18])
+    parser.add_argument("--zoom-id", default="20")
+    parser.add_argument("--output-dir", default="./results/")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--images-in-flight", type=int, default=2)
+    parser.add_argument("--journal", default=pipeline.journal_path,
+                        help="JSONL journal of finished patches and images; rerun with the same file to resume")
+    parser.add_argument("--metrics", default=pipeline.telemetry["metrics_path"],
+                        help="Prometheus text file with per-stage timers and request counters")
+    parser.add_argument("--log", default=pipeline.telemetry["log_path"], help="JSON lines event log")
+    parser.add_argument("--profile", default=pipeline.telemetry["profile_path"],
+                        help="cProfile one image end to end before the batch starts and save the stats here")
+    args = parser.parse_args()
+    pipeline.journal_path = args.journal
+    pipeline.telemetry = {"log_path": args.log, "metrics_path": args.metrics, "profile_path": args.profile}
+
+    batch_runner(pipeline, args.image_dir, args.label_dir, args.shots, args.zoom_id, args.output_dir,
+                 args.workers, args.images_in_flight).run()
@@ -0,0 +1,63 @@
+import os
+import sys
+import time
+import argparse
+
+import cv2
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from encoder import patch_encoder
+
+
+SETTINGS = [
+    {"backend": "pil", "format": "jpeg", "quality": 95, "resample": "lanczos"},
+    {"backend": "cv2", "format": "jpeg", "quality": 95, "resample": "lanczos"},
+    {"backend": "cv2", "format": "jpeg", "quality": 85, "resample": "area"},
+    {"backend": "cv2", "format": "jpeg", "quality": 75, "resample": "area"},
+    {"backend": "cv2", "format": "webp", "quality": 80, "resample": "area"},
+    {"backend": "cv2", "format": "png", "quality": 95, "resample": "area"},
+    {"backend": "cv2", "format": "jpeg", "quality": 95, "resample": "area", "max_bytes": 4096},
+]
+
+
+def load_crops(image_dir, num_crops, seed=0):
+    # Random crops from real images when a directory is given, noise otherwise
+    rng = np.random.default_rng(seed)
+    crops = []
+    images = [cv2.imread(os.path.join(image_dir, f)) for f in sorted(os.listdir(image_dir))[:10]] if image_dir else []
+    images = [image for image in images if image is not None]
+    for _ in range(num_crops):
+        if images:
+            image = images[rng.integers(len(images))]
+            h, w = image.shape[:2]
+            size = int(rng.integers(60, min(h, w, 200)))
+            y, x = int(rng.integers(0, h - size)), int(rng.integers(0, w - size))
+            crops.append(image[y:y + size, x:x + size])
+        else:
+            crops.append(rng.integers(0, 256, size=(int(rng.integers(60, 200)),) * 2 + (3,), dtype=np.uint8))
+    return crops
+
+
+def run(crops, target_size, repeat):
+    print(f"{'setting':<40} {'ms/patch':>9} {'mean bytes':>11}")
+    for setting in SETTINGS:
+        encoder = patch_encoder(**setting)
+        sizes = [len(encoder.encode(crop, target_size)[0]) for crop in crops]
+        start = time.perf_counter()
+        for _ in range(repeat):
+            for crop in crops:
+                encoder.encode(crop, target_size)
+        elapsed = (time.perf_counter() - start) / (repeat * len(crops))
+        print(f"{encoder.signature:<40} {elapsed * 1000:>9.3f} {np.mean(sizes):>11.0f}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare patch encoder speed and payload size.")
+    parser.add_argument("--image-dir", default=None)
+    parser.add_argument("--num-crops", type=int, default=200)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--target-size", type=int, nargs=2, default=[124, 124])
+    args = parser.parse_args()
+
+    run(load_crops(args.image_dir, args.num_crops), tuple(args.target_size), args.repeat)
@@ -0,0 +1,237 @@
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import resource
+import platform
+import subprocess
+import threading
+
+import cv2
+import numpy as np
+import matplotlib
+matplotlib.use("Agg")
+import matplotlib.pyplot as plt
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+os.environ.setdefault("OPENAI_API_KEY", "benchmark")
+os.environ.setdefault("GOOGLE_API_KEY", "benchmark")
+
+from main import vlm_detection
+from config import pipeline
+from utils import load_image, map_shape_to_bbox, plot
+from overlay import get_overlay_writer
+from metric import get_iou, detector_iou
+from labels import SHAPE_NAMES
+from region_proposal import detector
+from region_classification import classifier
+from example_bank import load_example_bank
+from example_index import example_index
+from api.mock_server import serve, mock_settings
+
+
+def make_dataset(out_dir, num_images, image_size, cells_per_image, seed=0):
+    # Synthetic AFM-like frames: noisy background with round, spindle and
+    # polygonal blobs, written as PNG plus YOLO labels (class cx cy w h).
+    rng = np.random.default_rng(seed)
+    image_dir, label_dir = os.path.join(out_dir, "images"), os.path.join(out_dir, "labels")
+    os.makedirs(image_dir, exist_ok=True)
+    os.makedirs(label_dir, exist_ok=True)
+
+    height, width = image_size
+    for n in range(num_images):
+        image = rng.normal(60, 12, size=(height, width, 3)).clip(0, 255).astype(np.uint8)
+        image = cv2.GaussianBlur(image, (5, 5), 0)
+        lines = []
+        for _ in range(cells_per_image):
+            cls = int(rng.integers(len(SHAPE_NAMES)))
+            cx, cy = int(rng.integers(40, width - 40)), int(rng.integers(40, height - 40))
+            color = tuple(int(c) for c in rng.integers(140, 230, size=3))
+            mask = np.zeros((height, width), dtype=np.uint8)
+            if cls == 0:
+                cv2.circle(mask, (cx, cy), int(rng.integers(10, 25)), 255, -1)
+            elif cls == 1:
+                axes = (int(rng.integers(22, 38)), int(rng.integers(5, 10)))
+                cv2.ellipse(mask, (cx, cy), axes, float(rng.uniform(0, 180)), 0, 360, 255, -1)
+            else:
+                angles = np.sort(rng.uniform(0, 2 * np.pi, size=int(rng.integers(5, 8))))
+                radii = rng.uniform(12, 28, size=len(angles))
+                points = np.stack([cx + radii * np.cos(angles), cy + radii * np.sin(angles)], axis=1)
+                cv2.fillPoly(mask, [points.astype(np.int32)], 255)
+
+            image[mask > 0] = color
+            x, y, w, h = cv2.boundingRect(mask)
+            lines.append(f"{cls} {(x + w / 2) / width:.6f} {(y + h / 2) / height:.6f} {w / width:.6f} {h / height:.6f}")
+
+        name = f"synthetic_{n}"
+        cv2.imwrite(os.path.join(image_dir, f"{name}.png"), image)
+        with open(os.path.join(label_dir, f"{name}.txt"), "w") as file:
+            file.write("\n".join(lines) + "\n")
+    return image_dir, label_dir
+
+
+def process_peak_rss_mb():
+    # High-water mark of the whole process so far, not the usage of one stage;
+    # ru_maxrss is KiB on Linux and bytes on macOS
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return rss / (1024 ** 2 if platform.system() == "Darwin" else 1024)
+
+
+class stage_timer():
+    def __init__(self):
+        self.stages = {}
+
+    def time(self, name, fn, items=1):
+        start = time.perf_counter()
+        result = fn()
+        elapsed = time.perf_counter() - start
+        stage = self.stages.setdefault(name, {"latencies": [], "items": 0})
+        stage["latencies"].append(elapsed)
+        stage["items"] += items
+        stage["process_peak_rss_mb"] = process_peak_rss_mb()
+        return result
+
+    def report(self):
+        report = {}
+        for name, stage in self.stages.items():
+            latencies = np.array(stage["latencies"]) * 1000
+            p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+            report[name] = {
+                "calls": len(latencies),
+                "items": stage["items"],
+                "total_s": float(latencies.sum() / 1000),
+                "items_per_s": float(stage["items"] / max(latencies.sum() / 1000, 1e-9)),
+                "mean_ms": float(latencies.mean()),
+                "p50_ms": float(p50),
+                "p90_ms": float(p90),
+                "p99_ms": float(p99),
+                "process_peak_rss_mb": float(stage["process_peak_rss_mb"]),
+            }
+        return report
+
+
+def get_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, text=True).strip()
+    except Exception:
+        return None
+
+
+def run(args):
+    random.seed(args.seed)
+    image_dir, label_dir = make_dataset(args.data_dir, args.num_images, tuple(args.image_size),
+                                        args.cells_per_image, args.seed)
+    names = sorted(os.listdir(image_dir))
+
+    # Classification goes through the real client and encoder against the
+    # local mock server, so only the network latency is synthetic.
+    settings = mock_settings(latency="constant", latency_ms=args.mock_latency_ms, seed=args.seed)
+    server = serve(port=args.mock_port, settings=settings)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    bank_dir = os.path.join(args.data_dir, "example_bank")
+    shutil.rmtree(bank_dir, ignore_errors=True)
+    session = classifier(image_dir, label_dir, shot=0, target_size=tuple(args.target_size),
+                         vlm_model_type="gpt", vlm="benchmark", batch_size=args.batch_size,
+                         example_bank_dir=bank_dir, example_selection=args.example_selection,
+                         rate_limits={"gpt": {"requests_per_minute": 10 ** 6}},
+                         base_urls={"gpt": f"http://127.0.0.1:{args.mock_port}"})
+
+    class bench_config(pipeline):
+        filter_area = False
+        plot = False
+        journal_path = None
+        max_box = args.max_box
+        max_concurrency = args.max_concurrency
+
+    timer = stage_timer()
+    for name in names:
+        img_path = os.path.join(image_dir, name)
+        label_path = os.path.join(label_dir, name.split('.')[0] + ".txt")
+        image = cv2.imread(img_path)
+        detection = vlm_detection(img_path, bench_config, session=session)
+
+        bbox = timer.time("proposal_selective_search",
+                          lambda: detector(image=image).get_all_bbox_selective_search(args.max_box))
+        if args.sam_checkpoint:
+            timer.time("proposal_sam", lambda: detector(image=image).get_all_bbox_sam(
+                args.sam_checkpoint, args.sam_model_type, bench_config.padding))
+
+        patches = timer.time("get_image_patches", lambda: list(detection.get_image_patches(image, bbox)), len(bbox))
+        timer.time("load_image", lambda: [load_image(patch, tuple(args.target_size)) for patch in patches], len(patches))
+        preds = timer.time("classification", lambda: asyncio.run(session.aclassify_all(
+            iter(patches), max_concurrency=args.max_concurrency, encode=session.encode)), len(patches))
+        shapes = timer.time("map_shape_to_bbox", lambda: map_shape_to_bbox(preds, bbox), len(bbox))
+        timer.time("get_iou", lambda: get_iou(shapes, label_path, img_path))
+        timer.time("detector_iou", lambda: detector_iou(bbox, label_path, img_path))
+        if args.plot:
+            save_filename = os.path.join(args.data_dir, f"plot_{name}")
+            timer.time("plot_matplotlib", lambda: (plot(img_path, shapes, save_filename=save_filename), plt.close("all")))
+            overlay_filename = os.path.join(args.data_dir, f"overlay_{name}")
+            timer.time("plot_overlay", lambda: get_overlay_writer().submit(image, shapes, overlay_filename))
+
+    # Few-shot examples as the session gets them: the bank is built once, then
+    # loaded and sampled (or queried through the kNN index) per request.
+    target_size = tuple(args.target_size)
+    timer.time("example_bank_build", lambda: load_example_bank(image_dir, label_dir, target_size, session.padding,
+                                                               bank_dir, session.encoder))
+    if args.example_selection == "knn":
+        index = timer.time("example_index_build", lambda: example_index(session.get_example_bank(), target_size))
+    for repeat in range(args.example_repeats):
+        bank = timer.time("example_bank_load", lambda: load_example_bank(image_dir, label_dir, target_size,
+                                                                         session.padding, bank_dir, session.encoder))
+        timer.time("example_bank_sample", lambda: bank.sample(args.shots, seed=args.seed + repeat), args.shots)
+        if args.example_selection == "knn":
+            query = patches[:args.batch_size]
+            timer.time("example_index_select", lambda: index.select(query, args.shots, target_size), len(query))
+
+    timer.time("overlay_flush", get_overlay_writer().flush)
+    server.shutdown()
+    return {
+        "commit": get_commit(),
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "settings": vars(args),
+        "mock_server": dict(settings.stats),
+        "process_peak_rss_mb": process_peak_rss_mb(),
+        "stages": timer.report(),
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Time each pipeline stage on synthetic cell images.")
+    parser.add_argument("--data-dir", default="./benchmarks/data")
+    parser.add_argument("--output", default=None, help="defaults to ./benchmarks/results/<commit>.json")
+    parser.add_argument("--num-images", type=int, default=20)
+    parser.add_argument("--image-size", type=int, nargs=2, default=[512, 512])
+    parser.add_argument("--cells-per-image", type=int, default=20)
+    parser.add_argument("--target-size", type=int, nargs=2, default=[124, 124])
+    parser.add_argument("--max-box", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--max-concurrency", type=int, default=8)
+    parser.add_argument("--mock-latency-ms", type=float, default=0.0)
+    parser.add_argument("--mock-port", type=int, default=8765)
+    parser.add_argument("--shots", type=int, default=6)
+    parser.add_argument("--example-repeats", type=int, default=5)
+    parser.add_argument("--example-selection", choices=["random", "knn"], default="random")
+    parser.add_argument("--sam-checkpoint", default=None, help="also time SAM proposals when given")
+    parser.add_argument("--sam-model-type", default="vit_h")
+    parser.add_argument("--no-plot", dest="plot", action="store_false")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    results = run(args)
+    output = args.output or os.path.join("./benchmarks/results", f"{results['commit'] or 'local'}.json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w") as file:
+        json.dump(results, file, indent=2)
+
+    print(f"{'stage':<28} {'items/s':>10} {'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'proc rss MB':>12}")
+    for name, stage in results["stages"].items():
+        print(f"{name:<28} {stage['items_per_s']:>10.1f} {stage['p50_ms']:>9.2f} {stage['p90_ms']:>9.2f} "
+              f"{stage['p99_ms']:>9.2f} {stage['process_peak_rss_mb']:>12.0f}")
+    print(f"Saved {output}")
@@ -0,0 +1,83 @@
+import numpy as np
+
+
+def as_boxes(boxes):
+    return np.asarray(boxes, dtype=np.float64).reshape(-1, 4)
+
+
+def box_area(boxes):
+    boxes = as_boxes(boxes)
+    return (boxes[:, 2] - boxes[:, 0]) * (boxes[:, 3] - boxes[:, 1])
+
+
+def intersection_matrix(boxes1, boxes2):
+    boxes1, boxes2 = as_boxes(boxes1), as_boxes(boxes2)
+    top_left = np.maximum(boxes1[:, None, :2], boxes2[None, :, :2])
+    bottom_right = np.minimum(boxes1[:, None, 2:], boxes2[None, :, 2:])
+    wh = np.clip(bottom_right - top_left, 0, None)
+    return wh[..., 0] * wh[..., 1]
+
+
+def iou_matrix(boxes1, boxes2):
+    # Pairwise IoU of (N, 4) and (M, 4) boxes in (x1, y1, x2, y2) -> (N, M)
+    inter = intersection_matrix(boxes1, boxes2)
+    union = box_area(boxes1)[:, None] + box_area(boxes2)[None, :] - inter
+    return np.divide(inter, union, out=np.zeros_like(inter), where=union > 0)
+
+
+def containment_matrix(boxes1, boxes2):
+    # Fraction of each boxes1[i] that lies inside boxes2[j] -> (N, M)
+    inter = intersection_matrix(boxes1, boxes2)
+    area = box_area(boxes1)[:, None]
+    return np.divide(inter, area, out=np.zeros_like(inter), where=area > 0)
+
+
+def nms(boxes, scores, iou_threshold=0.5):
+    # Greedy non-maximum suppression; returns kept indices by descending score.
+    boxes = as_boxes(boxes)
+    order = np.argsort(-np.asarray(scores, dtype=np.float64), kind="stable")
+    keep = []
+    while order.size:
+        i = order[0]
+        keep.append(i)
+        if order.size == 1:
+            break
+        iou = iou_matrix(boxes[i], boxes[order[1:]])[0]
+        order = order[1:][iou <= iou_threshold]
+    return np.array(keep, dtype=np.int64)
+
+
+def filter_proposals(boxes, min_area=None, max_area=None, iou_threshold=0.5, containment_threshold=0.9):
+    # Drops out-of-range, overlapping and nested proposals before they turn
+    # into VLM calls. A box nested in exactly one larger box is dropped, so a
+    # whole cell beats its part; a box holding several others most likely
+    # spans touching cells, so it is dropped and they are kept.
+    # Returns the kept indices into `boxes` and how many each step dropped.
+    boxes = as_boxes(boxes)
+    area = box_area(boxes)
+    stats = {"proposals": len(boxes), "area": 0, "nms": 0, "containment": 0}
+
+    candidates = np.arange(len(boxes))
+    if min_area is not None and max_area is not None:
+        candidates = candidates[(area[candidates] > min_area) & (area[candidates] < max_area)]
+    stats["area"] = len(boxes) - len(candidates)
+
+    if iou_threshold is not None and len(candidates):
+        kept = candidates[nms(boxes[candidates], area[candidates], iou_threshold)]
+        stats["nms"] = len(candidates) - len(kept)
+        candidates = kept
+
+    candidates = candidates[np.argsort(-area[candidates], kind="stable")]
+    if containment_threshold is not None and len(candidates) > 1:
+        inside = containment_matrix(boxes[candidates], boxes[candidates])
+        # only a larger box (earlier in the order) can contain a smaller one
+        nested = np.tril(inside, k=-1) >= containment_threshold
+        spans_several = nested.sum(axis=0) >= 2
+        part = (nested & ~spans_several[None, :]).any(axis=1)
+        dropped = spans_several | part
+        stats["containment"] = int(dropped.sum())
+        candidates = candidates[~dropped]
+
+    keep = np.sort(candidates)
+    stats["kept"] = len(keep)
+    return keep, stats
@@ -20,6 +20,22 @@ class prompts:
     - Do not include any additional text, quotes, or formatting.
     """
     
+    BATCH_CELL_CLASSIFICATION = """
+    You will be provided with {num_patches} image crops of microscopic cells from a NIH-3T3 microscopy image, labeled `Patch 1` to `Patch {num_patches}`. Each cropped image is 124x124 pixels and should contain only one cell.
+
+    **Your task is to classify the cell shape in every patch into one of the following categories based on its appearance:**
+
+    1. **Round**: Cells appear circular, and sometimes with smooth edges.
+    2. **Spindle**: Cells are elongated and tapered, resembling a spindle or stretched ellipse.
+    3. **Polygonal**: Cells have multiple angles or sides.
+    4. **None**: Any other shape, multiple cells, no visible cell, or ambiguous cases.
+
+    **Response Format:**
+    - Return a JSON array with exactly {num_patches} strings, one label (`Round`, `Spindle`, `Polygonal`, or `None`) per patch, in patch order.
+    - Example for three patches: ["Round", "None", "Spindle"]
+    - Do not include any additional text or formatting.
+    """
+    
     DETECTION_CLASSIFICATION = """
     You will be provided with an NIH-3T3 microscopy image. The image dimension is 124x124 pixels.
     Your task is to detect and return bounding boxes for three different cell shapes: **round**, **spindle**, and **polygonal**.
@@ -75,16 +91,71 @@ class pipeline:
     filter_area = True
     area_label_dir = "./dataset/labels/validation/"
     area_image_dir = "./dataset/images/validation"
+    area_stats_cache = "./cache/area_stats.json"
     max_box = 80
     detector = "sam"
     sam_checkpoint = "/work/mech-ai-scratch/shreyang/AFM/VLMs/sam-model/sam_vit_h_4b8939.pth"
     sam_model_type = "vit_h"
+    sam_device = None  # None picks cuda when available, else cpu
+    torch_threads = None
+    sam_tile_size = None  # e.g. 1024 to run SAM tile by tile on large images
+    sam_tile_overlap = 256
+    sam_tile_workers = 1
     padding = 12
+    dedup_proposals = False  # not yet evaluated against the baseline IoU
+    nms_iou_threshold = 0.5
+    containment_threshold = 0.9
+    shape_prior = {
+        "enabled": False,  # label clear-cut SAM masks locally and send only the rest to the VLM
+        "threshold": 0.9,  # minimum shape score for a local label
+    }
     shot = 0
     vlm_model_type = "gemini"
     vlm = "gemini-1.5-pro"
     target_size = (124, 124)
+    encoder = {"backend": "cv2", "format": "jpeg", "quality": 95, "resample": "lanczos", "max_bytes": None}
+    max_concurrency = 8
+    http = {"pool_size": None, "connect_timeout": 10, "read_timeout": 120, "gzip_requests": False}  # pool_size None follows max_concurrency
+    batch_size = 1  # patches per request; above 1 the model answers a JSON array for several patches at once
+    rate_limits = {
+        "gpt": {"requests_per_minute": 500, "tokens_per_minute": None},
+        "gemini": {"requests_per_minute": 150, "tokens_per_minute": None},
+    }
+    api_base_urls = {"gpt": None, "gemini": None}  # e.g. "http://127.0.0.1:8000" for api/mock_server.py
+    resilience = {
+        "base_delay": 1.0,  # exponential backoff with jitter, capped at max_delay
+        "max_delay": 60.0,
+        "failure_threshold": 5,  # consecutive failures before the circuit opens
+        "reset_timeout": 60.0,
+        "hedge": False,  # send a second copy of calls slower than the observed p95
+    }
+    cache_path = "./cache/responses.sqlite"
+    cache_max_bytes = 512 * 1024 ** 2
+    rate_limit_dir = "./cache/rate_limits"  # token bucket files, one per provider, API key and model
+    journal_path = None  # e.g. "./results/journal.jsonl" to make runs resumable
+    batch_jobs = {
+        "dir": "./batch",  # requests.jsonl, manifest.json, job.json and results.jsonl for offline_batch.py
+        "backend": "provider",  # or "local": a file-based stand-in that replays the job against api_base_urls
+        "poll_interval": 60,
+        "completion_window": "24h",
+    }
+    telemetry = {
+        "log_path": None,  # JSON lines: one record per image plus a run summary
+        "metrics_path": None,  # Prometheus text file, rewritten at the end of each run
+        "profile_path": None,  # cProfile stats for the first image processed
+    }
     plot = True
+    overlay = {
+        "thickness": 1,
+        "labels": True,  # class initial next to each box
+        "queue_size": 16,  # overlays waiting for the background writer
+        "contact_sheet": False,  # batch_runner: one grid of all images per shot
+        "sheet_columns": 6,
+        "tile_size": 256,
+    }
     save_filename = "./results/test.png"
     example_image_dir = "./dataset/images/train"
-    example_label_dir = "./dataset/labels/train"
\ No newline at end of file
+    example_label_dir = "./dataset/labels/train"
+    example_bank_dir = "./cache/example_bank"
+    example_seed = 0
+    example_selection = "random"  # or "knn": nearest bank crops to each patch (batch mean) from a descriptor index
\ No newline at end of file
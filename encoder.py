@@ -0,0 +1,103 @@
+import io
+import base64
+
+import cv2
+import numpy as np
+from PIL import Image
+
+
+MIME_TYPES = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+CV2_RESAMPLE = {
+    "nearest": cv2.INTER_NEAREST,
+    "bilinear": cv2.INTER_LINEAR,
+    "bicubic": cv2.INTER_CUBIC,
+    "area": cv2.INTER_AREA,
+    "lanczos": cv2.INTER_LANCZOS4,
+}
+
+PIL_RESAMPLE = {
+    "nearest": Image.Resampling.NEAREST,
+    "bilinear": Image.Resampling.BILINEAR,
+    "bicubic": Image.Resampling.BICUBIC,
+    "area": Image.Resampling.BOX,
+    "lanczos": Image.Resampling.LANCZOS,
+}
+
+
+class patch_encoder():
+    # Turns an image array into a base64 payload for the VLM request.
+    # backend="pil" reproduces the original load_image output byte for byte;
+    # backend="cv2" is the fast path. With max_bytes set, lossy formats step
+    # the quality down until the encoded image fits (or min_quality is hit).
+    def __init__(self, backend="pil", format="jpeg", quality=95, resample="lanczos", max_bytes=None, min_quality=40):
+        if format not in MIME_TYPES:
+            raise ValueError(f"Unsupported image format: {format}")
+        if backend not in ("pil", "cv2"):
+            raise ValueError(f"Unsupported encoder backend: {backend}")
+        self.backend = backend
+        self.format = format
+        self.quality = quality
+        self.resample = resample
+        self.max_bytes = max_bytes
+        self.min_quality = min_quality
+
+    @property
+    def mime_type(self):
+        return MIME_TYPES[self.format]
+
+    @property
+    def signature(self):
+        return f"{self.backend}-{self.format}-q{self.quality}-{self.resample}-{self.max_bytes}"
+
+    def to_rgb_array(self, image_array):
+        image = np.asarray(image_array).astype(np.uint8, copy=False)
+        if image.ndim == 2:
+            image = np.stack([image] * 3, axis=-1)
+        return image[..., :3]
+
+    def encode_bytes(self, image, quality):
+        # image is (H, W, 3) and, like the PIL path, read as RGB
+        if self.backend == "cv2":
+            if self.format == "jpeg":
+                params = [cv2.IMWRITE_JPEG_QUALITY, quality]
+            elif self.format == "webp":
+                params = [cv2.IMWRITE_WEBP_QUALITY, quality]
+            else:
+                params = [cv2.IMWRITE_PNG_COMPRESSION, 3]
+            ok, buffer = cv2.imencode(f".{self.format}", np.ascontiguousarray(image[..., ::-1]), params)
+            if not ok:
+                raise ValueError(f"cv2 could not encode the image as {self.format}")
+            return buffer.tobytes()
+
+        buffer = io.BytesIO()
+        if self.format == "png":
+            Image.fromarray(image).save(buffer, format="PNG")
+        else:
+            Image.fromarray(image).save(buffer, format=self.format.upper(), quality=quality)
+        return buffer.getvalue()
+
+    def resize(self, image, target_size):
+        if self.backend == "cv2":
+            return cv2.resize(image, target_size, interpolation=CV2_RESAMPLE[self.resample])
+        return np.asarray(Image.fromarray(image).resize(target_size, PIL_RESAMPLE[self.resample]))
+
+    def encode(self, image_array, target_size=None):
+        image = self.to_rgb_array(image_array)
+        if target_size is not None:
+            image = self.resize(image, target_size)
+        height, width = image.shape[:2]
+
+        quality = self.quality
+        data = self.encode_bytes(image, quality)
+        while self.max_bytes and len(data) > self.max_bytes and self.format != "png" and quality > self.min_quality:
+            quality = max(self.min_quality, quality - 10)
+            data = self.encode_bytes(image, quality)
+
+        return base64.b64encode(data).decode('utf-8'), width, height
+
+
+_default_encoder = patch_encoder()
+
+def get_default_encoder():
+    return _default_encoder
@@ -0,0 +1,99 @@
+import os
+import random
+import cv2
+import numpy as np
+
+from utils import load_image
+from encoder import get_default_encoder
+from labels import SHAPE_NAMES, load_yolo_labels, get_directory_signature
+
+
+def get_example_bank_path(bank_dir, target_size, offset=0, encoder=None):
+    encoder = encoder or get_default_encoder()
+    return os.path.join(bank_dir, f"examples_{target_size[0]}x{target_size[1]}_pad{offset}_{encoder.signature}.npz")
+
+
+def build_example_bank(example_image_dir, example_label_dir, target_size, offset=0, bank_path=None, encoder=None):
+    # Extract, resize and encode every labeled crop once.
+    labels, encoded = [], []
+
+    for image_name in sorted(os.listdir(example_image_dir)):
+        img_name = image_name.split('.')[0]
+        label_file = os.path.join(example_label_dir, "{}.txt".format(img_name))
+        if not os.path.exists(label_file):
+            continue
+        img = cv2.imread(os.path.join(example_image_dir, image_name))
+        if img is None:
+            continue
+        img_height, img_width = img.shape[:2]
+
+        for cls, x1, y1, x2, y2 in load_yolo_labels(label_file, image_shape=(img_height, img_width)).tolist():
+            if cls not in SHAPE_NAMES:
+                continue
+            x1, y1 = max(x1 - offset, 0), max(y1 - offset, 0)
+            x2, y2 = min(x2 + offset, img_width), min(y2 + offset, img_height)
+            if x2 <= x1 or y2 <= y1:
+                continue
+
+            crop = img[y1:y2, x1:x2]
+            crop_encoded, _, _ = load_image(crop, target_size=target_size, encoder=encoder)
+            if crop_encoded is None:
+                continue
+            labels.append(cls)
+            encoded.append(crop_encoded)
+
+    if bank_path is not None:
+        if os.path.dirname(bank_path):
+            os.makedirs(os.path.dirname(bank_path), exist_ok=True)
+        np.savez_compressed(
+            bank_path,
+            labels=np.array(labels, dtype=np.int8),
+            encoded=np.array(encoded, dtype=np.bytes_),
+            signature=np.array(get_directory_signature(example_image_dir, example_label_dir)),
+        )
+
+    return labels, encoded
+
+
+class example_bank():
+    def __init__(self, bank_path):
+        data = np.load(bank_path)
+        self.bank_path = bank_path
+        self.labels = data["labels"]
+        self.encoded = data["encoded"]
+        self.signature = str(data["signature"])
+        self.index = {shape: np.flatnonzero(self.labels == cls) for cls, shape in SHAPE_NAMES.items()}
+
+    def sample(self, shots, seed=0):
+        # Seeded, O(k) selection of shots/3 encoded crops per class.
+        num_each = int(shots/3)
+        rng = random.Random(seed)
+        examples = {}
+        for shape in ["Round", "Spindle", "Polygonal"]:
+            index = self.index[shape]
+            picks = rng.sample(range(len(index)), min(num_each, len(index)))
+            examples[shape] = [self.encoded[index[i]].decode('ascii') for i in picks]
+        return examples
+
+
+def load_example_bank(example_image_dir, example_label_dir, target_size, offset=0, bank_dir="./cache/example_bank",
+                      encoder=None):
+    bank_path = get_example_bank_path(bank_dir, target_size, offset, encoder)
+    if os.path.exists(bank_path):
+        bank = example_bank(bank_path)
+        if bank.signature == get_directory_signature(example_image_dir, example_label_dir):
+            return bank
+    build_example_bank(example_image_dir, example_label_dir, target_size, offset, bank_path, encoder)
+    return example_bank(bank_path)
+
+
+if __name__ == "__main__":
+    from config import pipeline
+    from encoder import patch_encoder
+
+    encoder = patch_encoder(**pipeline.encoder)
+    bank_path = get_example_bank_path(pipeline.example_bank_dir, pipeline.target_size, pipeline.padding, encoder)
+    labels, _ = build_example_bank(pipeline.example_image_dir, pipeline.example_label_dir,
+                                      pipeline.target_size, pipeline.padding, bank_path, encoder)
+    counts = {shape: labels.count(cls) for cls, shape in SHAPE_NAMES.items()}
+    print(f"Saved {len(labels)} examples {counts} to {bank_path}")
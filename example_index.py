@@ -0,0 +1,116 @@
+import os
+import base64
+
+import cv2
+import numpy as np
+
+
+THUMB_SIZE = 16
+INTENSITY_BINS = 16
+ORIENTATION_BINS = 8
+
+
+def as_crops(patches, target_size):
+    # (N, H, W, 3) uint8 stack at target_size from raw crops or base64 strings
+    crops = []
+    for patch in patches:
+        if isinstance(patch, (str, bytes)):
+            patch = cv2.imdecode(np.frombuffer(base64.b64decode(patch), dtype=np.uint8), cv2.IMREAD_COLOR)
+        if patch.ndim == 2:
+            patch = cv2.cvtColor(patch, cv2.COLOR_GRAY2BGR)
+        if patch.shape[1::-1] != tuple(target_size):
+            patch = cv2.resize(patch, tuple(target_size), interpolation=cv2.INTER_AREA)
+        crops.append(patch[..., :3])
+    return np.stack(crops) if crops else np.zeros((0, target_size[1], target_size[0], 3), dtype=np.uint8)
+
+
+def describe(crops):
+    # Cheap global descriptors for a stack of equally sized crops, computed
+    # for the whole stack at once: a 16x16 contrast-normalised thumbnail, an
+    # intensity histogram and a magnitude-weighted gradient orientation
+    # histogram (a one-cell HOG). Rows are L2-normalised, so a dot product
+    # is the cosine similarity.
+    n, h, w = crops.shape[:3]
+    if n == 0:
+        return np.zeros((0, THUMB_SIZE * THUMB_SIZE + INTENSITY_BINS + ORIENTATION_BINS), dtype=np.float32)
+    gray = crops.astype(np.float32).mean(axis=3) / 255.0
+
+    bh, bw = h // THUMB_SIZE, w // THUMB_SIZE
+    thumb = gray[:, :bh * THUMB_SIZE, :bw * THUMB_SIZE].reshape(n, THUMB_SIZE, bh, THUMB_SIZE, bw).mean(axis=(2, 4))
+    thumb = thumb.reshape(n, -1)
+    thumb -= thumb.mean(axis=1, keepdims=True)
+    thumb /= np.linalg.norm(thumb, axis=1, keepdims=True) + 1e-6
+
+    bins = np.minimum((gray * INTENSITY_BINS).astype(np.int64), INTENSITY_BINS - 1).reshape(n, -1)
+    intensity = np.zeros((n, INTENSITY_BINS), dtype=np.float32)
+    np.add.at(intensity, (np.repeat(np.arange(n), bins.shape[1]), bins.ravel()), 1.0)
+    intensity /= np.linalg.norm(intensity, axis=1, keepdims=True) + 1e-6
+
+    gy, gx = np.gradient(gray, axis=(1, 2))
+    magnitude = np.hypot(gx, gy).reshape(n, -1)
+    angle = (np.arctan2(gy, gx) % np.pi).reshape(n, -1)
+    angle_bins = np.minimum((angle / np.pi * ORIENTATION_BINS).astype(np.int64), ORIENTATION_BINS - 1)
+    orientation = np.zeros((n, ORIENTATION_BINS), dtype=np.float32)
+    np.add.at(orientation, (np.repeat(np.arange(n), angle_bins.shape[1]), angle_bins.ravel()), magnitude.ravel())
+    orientation /= np.linalg.norm(orientation, axis=1, keepdims=True) + 1e-6
+
+    features = np.concatenate([thumb, 0.5 * intensity, 0.5 * orientation], axis=1).astype(np.float32)
+    return features / (np.linalg.norm(features, axis=1, keepdims=True) + 1e-6)
+
+
+def get_example_index_path(bank_path):
+    return bank_path[:-len(".npz")] + "_features.npy"
+
+
+def build_example_index(bank_path, target_size, index_path=None, chunk_size=1024):
+    # Descriptors of every bank crop, one row per crop, in bank order, from
+    # the encoded crops the bank already holds
+    encoded = np.load(bank_path)["encoded"]
+    features = np.concatenate([describe(as_crops(encoded[i:i + chunk_size], target_size))
+                               for i in range(0, len(encoded), chunk_size)]) \
+        if len(encoded) else describe(as_crops(encoded, target_size))
+    index_path = index_path or get_example_index_path(bank_path)
+    np.save(index_path + ".tmp.npy", features)
+    os.replace(index_path + ".tmp.npy", index_path)
+    return index_path
+
+
+class example_index():
+    # Memory-mapped descriptor matrix over an example_bank, queried with one
+    # matrix product per class.
+    def __init__(self, bank, target_size, index_path=None):
+        self.bank = bank
+        self.index_path = index_path or get_example_index_path(bank.bank_path)
+        if (not os.path.exists(self.index_path)
+                or os.path.getmtime(self.index_path) < os.path.getmtime(bank.bank_path)):
+            build_example_index(bank.bank_path, target_size, self.index_path)
+        self.features = np.load(self.index_path, mmap_mode="r")
+        if len(self.features) != len(bank.labels):
+            build_example_index(bank.bank_path, target_size, self.index_path)
+            self.features = np.load(self.index_path, mmap_mode="r")
+        self.class_features = {shape: np.asarray(self.features[rows]) for shape, rows in bank.index.items()}
+
+    def query(self, descriptors, k):
+        # Bank rows of the k most similar crops per class for each query row:
+        # {shape: (Q, <=k) array}, most similar first.
+        descriptors = np.atleast_2d(descriptors)
+        neighbours = {}
+        for shape, rows in self.bank.index.items():
+            kk = min(k, len(rows))
+            if kk == 0:
+                neighbours[shape] = np.zeros((len(descriptors), 0), dtype=np.int64)
+                continue
+            similarity = descriptors @ self.class_features[shape].T
+            top = np.argpartition(-similarity, kk - 1, axis=1)[:, :kk]
+            order = np.argsort(-np.take_along_axis(similarity, top, axis=1), axis=1)
+            neighbours[shape] = rows[np.take_along_axis(top, order, axis=1)]
+        return neighbours
+
+    def select(self, patches, shots, target_size):
+        # shots/3 encoded examples per class, nearest to the patch (or to the
+        # mean descriptor of a batch of patches)
+        descriptor = describe(as_crops(patches, target_size)).mean(axis=0, keepdims=True)
+        descriptor /= np.linalg.norm(descriptor) + 1e-6
+        neighbours = self.query(descriptor, int(shots / 3))
+        return {shape: [self.bank.encoded[i].decode('ascii') for i in neighbours[shape][0]]
+                for shape in ["Round", "Spindle", "Polygonal"]}
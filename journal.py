@@ -0,0 +1,80 @@
+import os
+import json
+import threading
+
+
+class result_journal():
+    # Append-only JSONL log of finished work. Every patch prediction and every
+    # finished image is written (and fsynced) as soon as it is known, so a
+    # restarted run can skip what is already done.
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.patches = {}
+        self.images = {}
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.load()
+        self.file = open(path, "a")
+
+    @staticmethod
+    def patch_key(image, box, shot, model):
+        return (os.path.abspath(image), tuple(int(v) for v in box), int(shot), model)
+
+    @staticmethod
+    def image_key(image, shot, model):
+        return (os.path.abspath(image), int(shot), model)
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path) as file:
+            for line in file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # torn last line from a crash
+                if record["type"] == "patch":
+                    key = self.patch_key(record["image"], record["box"], record["shot"], record["model"])
+                    self.patches[key] = record["prediction"]
+                elif record["type"] == "image":
+                    key = self.image_key(record["image"], record["shot"], record["model"])
+                    self.images[key] = record["result"]
+
+    def append(self, record):
+        with self.lock:
+            self.file.write(json.dumps(record) + "\n")
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def get_patch(self, image, box, shot, model):
+        return self.patches.get(self.patch_key(image, box, shot, model))
+
+    def record_patch(self, image, box, shot, model, prediction):
+        if prediction is None:
+            return  # failed calls are retried on the next run
+        self.patches[self.patch_key(image, box, shot, model)] = prediction
+        self.append({"type": "patch", "image": os.path.abspath(image), "box": [int(v) for v in box],
+                     "shot": int(shot), "model": model, "prediction": prediction})
+
+    def get_image(self, image, shot, model):
+        return self.images.get(self.image_key(image, shot, model))
+
+    def record_image(self, image, shot, model, result):
+        result = {shape: [[int(v) for v in box] for box in boxes] for shape, boxes in result.items()}
+        self.images[self.image_key(image, shot, model)] = result
+        self.append({"type": "image", "image": os.path.abspath(image), "shot": int(shot), "model": model,
+                     "result": result})
+
+    def close(self):
+        self.file.close()
+
+
+_journals = {}
+
+def get_journal(path):
+    if path is None:
+        return None
+    if path not in _journals:
+        _journals[path] = result_journal(path)
+    return _journals[path]
@@ -0,0 +1,105 @@
+import os
+import json
+import struct
+import hashlib
+from functools import lru_cache
+
+import cv2
+import numpy as np
+
+
+SHAPE_NAMES = {0: "Round", 1: "Spindle", 2: "Polygonal"}
+
+PNG_SIGNATURE = b"\x89PNG\r\n\x1a\n"
+JPEG_SOF_MARKERS = {0xC0, 0xC1, 0xC2, 0xC3, 0xC5, 0xC6, 0xC7, 0xC9, 0xCA, 0xCB, 0xCD, 0xCE, 0xCF}
+
+
+def _read_header_shape(path):
+    # (height, width) from the PNG IHDR chunk or the JPEG SOF segment,
+    # without decoding any pixels. Returns None for other formats.
+    with open(path, "rb") as file:
+        head = file.read(26)
+        if head[:8] == PNG_SIGNATURE and head[12:16] == b"IHDR":
+            width, height = struct.unpack(">II", head[16:24])
+            return height, width
+
+        if head[:2] == b"\xff\xd8":
+            file.seek(2)
+            while True:
+                marker = file.read(2)
+                if len(marker) < 2 or marker[0] != 0xFF:
+                    return None
+                if marker[1] in (0xD8, 0x01) or 0xD0 <= marker[1] <= 0xD7:
+                    continue
+                length = struct.unpack(">H", file.read(2))[0]
+                if marker[1] in JPEG_SOF_MARKERS:
+                    height, width = struct.unpack(">xHH", file.read(5))
+                    return height, width
+                file.seek(length - 2, os.SEEK_CUR)
+    return None
+
+
+@lru_cache(maxsize=None)
+def _image_shape(path, mtime_ns):
+    shape = _read_header_shape(path)
+    if shape is None:
+        shape = cv2.imread(path).shape[:2]
+    return shape
+
+
+def get_image_shape(img_path):
+    # (height, width) of an image, memoized per path and modification time
+    return _image_shape(img_path, os.stat(img_path).st_mtime_ns)
+
+
+def yolo_to_boxes(values, image_shape):
+    # (N, 5) YOLO rows -> (N, 5) int rows of (class, x1, y1, x2, y2) in pixels
+    img_height, img_width = image_shape
+    values = np.asarray(values, dtype=np.float64).reshape(-1, 5)
+    x_center_abs = np.trunc(values[:, 1] * img_width)
+    y_center_abs = np.trunc(values[:, 2] * img_height)
+    width_abs = np.trunc(values[:, 3] * img_width)
+    height_abs = np.trunc(values[:, 4] * img_height)
+
+    boxes = np.empty((len(values), 5), dtype=np.int64)
+    boxes[:, 0] = values[:, 0]
+    boxes[:, 1] = np.trunc(x_center_abs - width_abs / 2)
+    boxes[:, 2] = np.trunc(y_center_abs - height_abs / 2)
+    boxes[:, 3] = np.trunc(x_center_abs + width_abs / 2)
+    boxes[:, 4] = np.trunc(y_center_abs + height_abs / 2)
+    return boxes
+
+
+def read_yolo_file(label_path):
+    with open(label_path, "r") as file:
+        rows = [line.split() for line in file if line.strip()]
+    if not rows:
+        return np.zeros((0, 5), dtype=np.float64)
+    return np.array(rows, dtype=np.float64)
+
+
+def load_yolo_labels(label_path, img_path=None, image_shape=None):
+    # Boxes of a YOLO label file as an (N, 5) array of (class, x1, y1, x2, y2).
+    # Pixel size comes from image_shape, or from the header of img_path.
+    if image_shape is None:
+        image_shape = get_image_shape(img_path)
+    return yolo_to_boxes(read_yolo_file(label_path), image_shape)
+
+
+def group_by_shape(labels):
+    # (N, 5) label array -> {"Round": [...], "Spindle": [...], "Polygonal": [...]}
+    shapes = {shape: [] for shape in SHAPE_NAMES.values()}
+    for row in labels.tolist():
+        if row[0] in SHAPE_NAMES:
+            shapes[SHAPE_NAMES[row[0]]].append(tuple(row[1:]))
+    return shapes
+
+
+def get_directory_signature(*directories):
+    # Cheap staleness check: hash of file names, sizes and mtimes
+    entries = []
+    for directory in directories:
+        for name in sorted(os.listdir(directory)):
+            stat = os.stat(os.path.join(directory, name))
+            entries.append((name, stat.st_size, stat.st_mtime_ns))
+    return hashlib.sha256(json.dumps(entries).encode("utf-8")).hexdigest()
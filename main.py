@@ -1,48 +1,74 @@
-import os
 import cv2
-import random
-from utils import load_image
-from region_classification import classifier
+import time
+import asyncio
+from region_classification import get_session
 from region_proposal import detector
 from config import pipeline
-from utils import get_min_max_area, plot
+from utils import get_min_max_area
+from overlay import get_overlay_writer
 from metric import get_iou
+from box_ops import filter_proposals
+from shape_prior import pre_classify
+from journal import get_journal
+from telemetry import get_telemetry, profile_once
 
 class vlm_detection():
-    def __init__(self, img_path, config, custom_config=None):
+    def __init__(self, img_path, config, custom_config=None, session=None):
         self.img_path = img_path
         self.config = config
         self.max_box = config.max_box
         self.detector = config.detector
         self.sam_checkpoint = config.sam_checkpoint
         self.sam_model_type = config.sam_model_type
+        self.sam_device = config.sam_device
+        self.torch_threads = config.torch_threads
+        self.sam_tile_size = config.sam_tile_size
+        self.sam_tile_overlap = config.sam_tile_overlap
+        self.sam_tile_workers = config.sam_tile_workers
         self.padding = config.padding
         self.shot = config.shot
         self.vlm_model_type = config.vlm_model_type
         self.vlm = config.vlm
         self.target_size = config.target_size
+        self.max_concurrency = config.max_concurrency
         self.plot = config.plot
         self.save_filename = config.save_filename
         self.example_image_dir = config.example_image_dir
         self.example_label_dir = config.example_label_dir
+        self.dedup_proposals = config.dedup_proposals
+        self.nms_iou_threshold = config.nms_iou_threshold
+        self.containment_threshold = config.containment_threshold
+        self.shape_prior = config.shape_prior
         self.min_area = None
         self.max_area = None
         if config.filter_area:
-            self.min_area, self.max_area = get_min_max_area(config.area_label_dir, config.area_image_dir)
+            self.min_area, self.max_area = get_min_max_area(config.area_label_dir, config.area_image_dir, config.area_stats_cache)
         if custom_config is not None:
             self.load_custom_config(custom_config)
+        self.session = session
+        self.journal = get_journal(config.journal_path)
+        self.model = f"{self.vlm_model_type}:{self.vlm}"
+        self.telemetry = get_telemetry()
+        if config.telemetry.get("log_path"):
+            self.telemetry.open_log(config.telemetry["log_path"])
 
     def load_custom_config(self, custom_config):
         self.shot = custom_config["shot"]
         self.save_filename = custom_config["save_filename"]
 
-    def get_image_patches(self, img_path, bboxes):
-        img_patches = []
-        image = cv2.imread(img_path)
+    def get_session(self):
+        # created on first use, so proposal-only workers never load keys or clients
+        if self.session is None:
+            self.session = get_session(self.config)
+        return self.session
+
+    def get_image_patches(self, image, bboxes):
+        # Lazily yields crops as views of the decoded frame (no copies)
         for bbox in bboxes:
-            img_patches.append(image[bbox[1]:bbox[3], bbox[0]:bbox[2]])
+            yield image[bbox[1]:bbox[3], bbox[0]:bbox[2]]
 
-        return img_patches
+    def encode_patch(self, patch):
+        return self.get_session().encode(patch)
         
     def map_shape_to_bbox(self, res, box):
         shapes = {"Spindle": [], "Polygonal": [], "Round": []}
@@ -56,28 +82,107 @@ class vlm_detection():
                 
         return shapes
 
-    def process(self):
-            if self.detector=="sam":
-                bbox = detector(self.img_path).get_all_bbox_sam(self.sam_checkpoint, self.sam_model_type, 
-                                                                self.padding, self.min_area, self.max_area)
+    def propose(self, image):
+        return self.propose_with_priors(image)[0]
+
+    def propose_with_priors(self, image):
+        # Proposals plus a local label (or None) for each one. Labels come from
+        # the SAM mask shape when pipeline.shape_prior is enabled; proposals
+        # that get one never reach the VLM.
+        with self.telemetry.stage("propose", detector=self.detector):
+            bbox, masks = self.get_proposals(image)
+
+        priors = [None] * len(bbox)
+        if self.shape_prior["enabled"] and masks is not None and len(bbox):
+            with self.telemetry.stage("shape_prior"):
+                priors, _ = pre_classify(masks, self.shape_prior["threshold"])
+            resolved = sum(prior is not None for prior in priors)
+            print(f"Pre-classified {resolved}/{len(bbox)} proposals from their masks "
+                  f"({resolved / len(bbox):.0%} of VLM calls avoided)")
+            self.telemetry.count("preclassified_total", resolved)
+        return bbox, priors
+
+    def get_proposals(self, image):
+            # masks (cropped to each box) are only kept when the shape prior needs them
+            masks = None
+            return_masks = bool(self.shape_prior["enabled"])
+            if self.detector=="sam" and self.sam_tile_size:
+                bbox = detector(image=image).get_all_bbox_sam_tiled(self.sam_checkpoint, self.sam_model_type,
+                                                                    self.padding, self.min_area, self.max_area,
+                                                                    self.sam_device, self.torch_threads,
+                                                                    self.sam_tile_size, self.sam_tile_overlap,
+                                                                    self.sam_tile_workers, return_masks=return_masks)
+            elif self.detector=="sam":
+                bbox = detector(image=image).get_all_bbox_sam(self.sam_checkpoint, self.sam_model_type, 
+                                                              self.padding, self.min_area, self.max_area,
+                                                              self.sam_device, self.torch_threads, return_masks)
             else: 
-                bbox = detector(self.img_path).get_all_bbox_selective_search(self.max_box, self.min_area, self.max_area)
-
-            patches = self.get_image_patches(self.img_path, bbox)
-            shape_pred =[]
-
-            for patch in patches:
-                img, _, _ = load_image(patch, target_size=self.target_size)
-                if img is not None:
-                    pred = classifier(self.example_image_dir, self.example_label_dir, self.shot, 
-                                      self.target_size).classify(img, self.padding, self.vlm_model_type, self.vlm)
-                    shape_pred.append(pred)
-
-            bbox = self.map_shape_to_bbox(shape_pred, bbox)
-
-            if self.plot:
-                plot(self.img_path, bbox, self.save_filename, detection_plot=True)
+                bbox = detector(image=image).get_all_bbox_selective_search(self.max_box, self.min_area, self.max_area)
+            if self.detector=="sam" and return_masks:
+                bbox, masks = bbox
+
+            if self.dedup_proposals and len(bbox):
+                keep, stats = filter_proposals(bbox, self.min_area, self.max_area,
+                                               self.nms_iou_threshold, self.containment_threshold)
+                bbox = [bbox[i] for i in keep]
+                if masks is not None:
+                    masks = [masks[i] for i in keep]
+                print(f"Kept {stats['kept']}/{stats['proposals']} proposals (dropped area: {stats['area']}, "
+                      f"overlap: {stats['nms']}, nested: {stats['containment']})")
+                self.telemetry.count("proposals_total", stats["proposals"])
+                self.telemetry.count("proposals_kept_total", stats["kept"])
+
+            return bbox, masks
+
+    async def aclassify(self, image, bbox, priors=None):
+            shape_pred = list(priors) if priors is not None else [None] * len(bbox)
+            todo = [i for i in range(len(bbox)) if shape_pred[i] is None]
+            if self.journal is not None:
+                for i in todo:
+                    shape_pred[i] = self.journal.get_patch(self.img_path, bbox[i], self.shot, self.model)
+                todo = [i for i in todo if shape_pred[i] is None]
+
+            patches = self.get_image_patches(image, (bbox[i] for i in todo))
+
+            def record(i, pred):
+                if self.journal is not None:
+                    self.journal.record_patch(self.img_path, bbox[todo[i]], self.shot, self.model, pred)
+
+            start = time.perf_counter()
+            preds = await self.get_session().aclassify_all(patches, shot=self.shot, max_concurrency=self.max_concurrency,
+                                                           on_result=record, encode=self.encode_patch)
+            self.telemetry.observe("stage_seconds", time.perf_counter() - start, stage="classify")
+            self.telemetry.count("patches_classified_total", len(todo))
+            for i, pred in zip(todo, preds):
+                shape_pred[i] = pred
+
+            shapes = self.map_shape_to_bbox(shape_pred, bbox)
+            if self.journal is not None and all(pred is not None for pred in shape_pred):
+                self.journal.record_image(self.img_path, self.shot, self.model, shapes)
+            return shapes
 
+    def process(self):
+            if self.journal is not None:
+                done = self.journal.get_image(self.img_path, self.shot, self.model)
+                if done is not None:
+                    return done
+
+            with profile_once(self.config.telemetry.get("profile_path")):
+                start = time.perf_counter()
+                with self.telemetry.stage("read_image"):
+                    image = cv2.imread(self.img_path)
+                bbox, priors = self.propose_with_priors(image)
+                num_proposals = len(bbox)
+                bbox = asyncio.run(self.aclassify(image, bbox, priors))
+
+                if self.plot:
+                    with self.telemetry.stage("plot"):
+                        get_overlay_writer(self.config.overlay["queue_size"]).submit(
+                            image, bbox, self.save_filename, thickness=self.config.overlay["thickness"],
+                            labels=self.config.overlay["labels"])
+
+            self.telemetry.log("image", image=self.img_path, shot=self.shot, proposals=num_proposals,
+                               seconds=time.perf_counter() - start)
             return bbox
     
 if __name__ == "__main__":
@@ -88,82 +193,9 @@ if __name__ == "__main__":
 
     vlm_detection = vlm_detection(img_path, pipeline)
     bbox = vlm_detection.process()
+    get_telemetry().write(pipeline)
 
     iou = get_iou(bbox, label_file_path, img_path)
     print(iou)
-    
-    '''
-    ###############################################################
-    ######### SCRIPT TO RUN ANALYSIS ON MUTILPLE FILES ############
-    ###############################################################
-    image_folder_path = "dataset/images/train"
-    label_folder_path = "dataset/labels/train"
-    
-    shots = [0, 6, 12, 18]
-    zoom_id = "20"
-    
-    
-    image_files = [f for f in os.listdir(image_folder_path) if f.endswith(".png")]
-    label_files = [f for f in os.listdir(label_folder_path) if f.endswith(".txt")]
-
-    def parse_filename(filename):
-        parts = filename.rsplit("_", 1)
-        if len(parts) != 2 or not parts[1].startswith(zoom_id):
-            return None, None
-        experiment_id = parts[0]
-        zoom = parts[1]
-        return experiment_id, zoom
-
-    filtered_images = {}
-    for img in image_files:
-        experiment_id, zoom = parse_filename(img)
-        if experiment_id and zoom:
-            filtered_images[experiment_id] = os.path.join(image_folder_path, img)
-
-    filtered_labels = {}
-    for lbl in label_files:
-        experiment_id, zoom = parse_filename(lbl)
-        if experiment_id and zoom:
-            filtered_labels[experiment_id] = os.path.join(label_folder_path, lbl)
-    
-    
-    common_experiments = list(set(filtered_images.keys()) & set(filtered_labels.keys()))
-    common_experiments = random.sample(common_experiments, 10)
-    
-    common_experiments = ["8-24-20_11_3T3"]
-    output_dir = "./results/"
-    for shot in shots:
-        output_file_path = os.path.join(output_dir, f"shot_{shot}_iou_results.txt")
-        
-        with open(output_file_path, "w") as output_file:
-            average_iou = 0
-            output_file.write(f"Results for Shot {shot}:\n")
-            
-            for experiment_id in common_experiments:
-                img_path = filtered_images[experiment_id]
-                label_path = filtered_labels[experiment_id]
-                save_filename = f"{output_dir}{experiment_id}_{zoom_id}_{shot}.png"
-                custom_config = {
-                    "shot": shot,
-                    "save_filename": save_filename
-                }
-
-                print(f"Processing Experiment ID: {experiment_id}, Image: {img_path}, Label: {label_path}")
-                
-                vlm_detection_obj = vlm_detection(img_path, pipeline, custom_config)
-                bbox = vlm_detection_obj.process()
 
-                iou = get_iou(bbox, label_path, img_path)
-                print(f"IoU of {experiment_id}: {iou}")
-                
-                # Write IoU to the shot-specific file
-                output_file.write(f"Experiment ID: {experiment_id}, IoU: {iou:.4f}\n")
-                
-                average_iou += (iou / len(common_experiments))
-            
-            # Write the average IoU for the shot
-            print(f"Average IoU for Shot {shot}: {average_iou}")
-            output_file.write(f"\nAverage IoU for Shot {shot}: {average_iou:.4f}\n")
-        
-        print(f"IoU results for Shot {shot} saved to {output_file_path}")
-    '''
\ No newline at end of file
+    # Multi-image runs over experiment folders: see batch_runner.py
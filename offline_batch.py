@@ -0,0 +1,256 @@
+import os
+import ast
+import json
+import time
+import argparse
+
+import cv2
+
+from config import pipeline, prompts
+from metric import get_iou
+from utils import load_image, map_shape_to_bbox, generate_detection_examples
+from encoder import patch_encoder
+from batch_runner import batch_runner, get_worker_pool, get_worker_config, get_worker_detection
+from api.base import parse_batch_labels
+from api.detection import GPTAPI as DetectionGPTAPI, GeminiAPI as DetectionGeminiAPI
+from api.batch_jobs import DONE, write_batch_file, read_batch_results, get_batch_backend, wait_for_job
+
+
+def prepare_image(experiment_id, img_path):
+    # Runs in a CPU worker: proposals plus the encoded crops, which are all
+    # the parent needs to build request lines.
+    config = get_worker_config()
+    image = cv2.imread(img_path)
+    bbox, priors = get_worker_detection().propose_with_priors(image)
+    bbox = [list(map(int, box)) for box in bbox]
+    encoder = patch_encoder(**config.encoder)
+    # pre-classified proposals need no request, so they are not encoded
+    patches = [load_image(image[y1:y2, x1:x2], config.target_size, encoder)[0] if prior is None else None
+               for (x1, y1, x2, y2), prior in zip(bbox, priors)]
+    return experiment_id, bbox, priors, patches
+
+
+def prepare_detection_image(experiment_id, img_path):
+    config = get_worker_config()
+    image = cv2.imread(img_path)
+    encoded, _, _ = load_image(image, config.target_size, patch_encoder(**config.encoder))
+    return experiment_id, encoded
+
+
+class offline_batch(batch_runner):
+    # Same experiments and reports as batch_runner, but every request of the
+    # run goes into one provider batch job (OpenAI Batch or Gemini batch
+    # mode) instead of live calls, so there is no client-side rate limiting.
+    # Steps: prepare -> submit -> poll -> ingest; state lives in batch_dir so
+    # each step can run in a separate invocation.
+    def __init__(self, config, image_dir, label_dir, shots, zoom_id, output_dir="./results/", workers=None,
+                 task="classification"):
+        super().__init__(config, image_dir, label_dir, shots, zoom_id, output_dir, workers)
+        self.task = task
+        self.detection_examples = {}
+        settings = config.batch_jobs
+        self.batch_dir = settings["dir"]
+        self.requests_path = os.path.join(self.batch_dir, "requests.jsonl")
+        self.manifest_path = os.path.join(self.batch_dir, "manifest.json")
+        self.job_path = os.path.join(self.batch_dir, "job.json")
+        self.results_path = os.path.join(self.batch_dir, "results.jsonl")
+        self.poll_interval = settings["poll_interval"]
+
+        self.api = self.session.api if task == "classification" else self.get_detection_api()
+        base_url = (config.api_base_urls or {}).get(config.vlm_model_type)
+        self.backend = get_batch_backend(self.api, settings["backend"], os.path.join(self.batch_dir, "jobs"),
+                                         base_url, settings["completion_window"])
+
+    def get_detection_api(self):
+        base_url = (self.config.api_base_urls or {}).get(self.config.vlm_model_type)
+        if self.config.vlm_model_type == "gpt":
+            return DetectionGPTAPI(os.environ["OPENAI_API_KEY"], self.config.vlm, base_url=base_url,
+                                   rate_limit_dir=self.config.rate_limit_dir)
+        return DetectionGeminiAPI(os.environ["GOOGLE_API_KEY"], self.config.vlm, base_url=base_url,
+                                  rate_limit_dir=self.config.rate_limit_dir)
+
+    def prepare(self):
+        requests, manifest = [], {}
+        with get_worker_pool(self.config, self.workers) as pool:
+            if self.task == "classification":
+                jobs = [pool.submit(prepare_image, experiment_id, img_path)
+                        for experiment_id, (img_path, _) in self.experiments.items()]
+                for job in jobs:
+                    self.add_classification_requests(*job.result(), requests, manifest)
+            else:
+                jobs = [pool.submit(prepare_detection_image, experiment_id, img_path)
+                        for experiment_id, (img_path, _) in self.experiments.items()]
+                for job in jobs:
+                    self.add_detection_requests(*job.result(), requests, manifest)
+
+        write_batch_file(self.api, requests, self.requests_path)
+        with open(self.manifest_path, "w") as file:
+            json.dump({"task": self.task, "model": self.model, "requests": manifest}, file)
+        print(f"Wrote {len(requests)} requests for {len(self.experiments)} images to {self.requests_path}")
+        return self.requests_path
+
+    def add_classification_requests(self, experiment_id, bbox, priors, patches, requests, manifest):
+        # Patches of one image are grouped batch_size at a time, like the live path
+        items = [(box, patch) for box, patch in zip(bbox, patches) if patch is not None]
+        batch_size = max(1, self.config.batch_size)
+        for shot in self.shots:
+            for n in range(0, len(items), batch_size):
+                chunk = items[n:n + batch_size]
+                examples = self.session.get_examples(shot, [patch for _, patch in chunk])
+                custom_id = f"{experiment_id}:{shot}:{n // batch_size}"
+                if len(chunk) > 1:
+                    inputs = {"prompt": self.session.batch_prompt.format(num_patches=len(chunk)),
+                              "images": [patch for _, patch in chunk], "mime_type": self.session.encoder.mime_type}
+                    payload = self.api.build_batch_payload(inputs, examples)
+                else:
+                    inputs = {"prompt": self.session.prompt, "image": chunk[0][1],
+                              "mime_type": self.session.encoder.mime_type}
+                    payload = self.api.build_payload(inputs, examples)
+                requests.append((custom_id, payload))
+                manifest[custom_id] = {"experiment_id": experiment_id, "shot": shot, "boxes": [box for box, _ in chunk]}
+            manifest[f"{experiment_id}:{shot}:all"] = {"experiment_id": experiment_id, "shot": shot, "boxes": bbox,
+                                                       "priors": priors}
+
+    def add_detection_requests(self, experiment_id, encoded, requests, manifest):
+        for shot in self.shots:
+            if shot not in self.detection_examples:
+                self.detection_examples[shot] = generate_detection_examples(
+                    self.config.example_image_dir, self.config.example_label_dir, shot,
+                    self.config.target_size, self.session.encoder) if shot > 0 else []
+            examples = self.detection_examples[shot]
+            # the image and examples use the configured encoder, which need not be JPEG
+            inputs = {"prompt": prompts.SINGLE_CLASS_DETECTION_CLASSIFICATION, "image": encoded,
+                      "mime_type": self.session.encoder.mime_type}
+            custom_id = f"{experiment_id}:{shot}:detection"
+            requests.append((custom_id, self.api.build_payload(inputs, examples)))
+            manifest[custom_id] = {"experiment_id": experiment_id, "shot": shot}
+
+    def submit(self):
+        job_id = self.backend.submit(self.requests_path)
+        with open(self.job_path, "w") as file:
+            json.dump({"job_id": job_id, "provider": self.api.provider, "submitted": time.time()}, file)
+        print(f"Submitted batch job {job_id}")
+        return job_id
+
+    def poll(self, timeout=None):
+        with open(self.job_path) as file:
+            job_id = json.load(file)["job_id"]
+        state, job = wait_for_job(self.backend, job_id, self.poll_interval, timeout)
+        if state != DONE:
+            print(f"Batch job {job_id} ended as {state}: {job}")
+            return None
+        self.backend.download(job, self.results_path)
+        print(f"Batch job {job_id} finished, results in {self.results_path}")
+        return self.results_path
+
+    def parse(self, body, num_boxes):
+        try:
+            if self.task == "detection":
+                return ast.literal_eval(self.api.parse_response(body))
+            if num_boxes > 1:
+                return parse_batch_labels(self.api.extract_text(body), num_boxes)
+            return [self.api.parse_response(body)]
+        except Exception as e:
+            print(f"Could not parse a batch result: {e}")
+            return None
+
+    def ingest(self):
+        with open(self.manifest_path) as file:
+            manifest = json.load(file)["requests"]
+        results = read_batch_results(self.results_path)
+
+        preds = {}
+        ingested = failed = 0
+        for custom_id, entry in manifest.items():
+            if custom_id.endswith(":all"):
+                continue
+            ingested += 1
+            body, error = results.get(custom_id, (None, "missing from the result file"))
+            parsed = self.parse(body, len(entry.get("boxes", []))) if body is not None else None
+            if parsed is None:
+                failed += 1
+                continue
+            key = (entry["experiment_id"], entry["shot"])
+            if self.task == "detection":
+                preds[key] = parsed
+            else:
+                for box, label in zip(entry["boxes"], parsed):
+                    preds.setdefault(key, {})[tuple(box)] = label
+        print(f"Ingested {ingested - failed}/{ingested} results, {failed} failed or unparsable")
+
+        if self.task == "detection":
+            return self.write_detections(preds)
+        return self.score(manifest, preds)
+
+    def score(self, manifest, preds):
+        # Predictions go through the journal like a live run, so batch_runner
+        # with the same journal only re-requests the patches that failed here.
+        ious = {shot: {} for shot in self.shots}
+        for custom_id, entry in manifest.items():
+            if not custom_id.endswith(":all"):
+                continue
+            experiment_id, shot, bbox = entry["experiment_id"], entry["shot"], entry["boxes"]
+            img_path, label_path = self.experiments[experiment_id]
+            labels = [prior or preds.get((experiment_id, shot), {}).get(tuple(box))
+                      for box, prior in zip(bbox, entry.get("priors") or [None] * len(bbox))]
+            if self.journal is not None:
+                for box, label in zip(bbox, labels):
+                    if label is not None:
+                        self.journal.record_patch(img_path, box, shot, self.model, label)
+
+            shapes = map_shape_to_bbox(labels, bbox)
+            if self.journal is not None and all(label is not None for label in labels):
+                self.journal.record_image(img_path, shot, self.model, shapes)
+            if self.config.plot:
+                save_filename = os.path.join(self.output_dir, f"{experiment_id}_{self.zoom_id}_{shot}.png")
+                self.write_overlay(experiment_id, shot, cv2.imread(img_path), shapes, save_filename)
+            ious[shot][experiment_id] = get_iou(shapes, label_path, img_path)
+
+        self.write_reports(ious)
+        return ious
+
+    def write_detections(self, preds):
+        os.makedirs(self.output_dir, exist_ok=True)
+        for shot in self.shots:
+            output_file_path = os.path.join(self.output_dir, f"shot_{shot}_detections.json")
+            with open(output_file_path, "w") as file:
+                json.dump({experiment_id: shapes for (experiment_id, s), shapes in preds.items() if s == shot}, file)
+            print(f"Detections for Shot {shot} saved to {output_file_path}")
+        return preds
+
+    def run(self, timeout=None):
+        self.prepare()
+        self.submit()
+        if self.poll(timeout) is None:
+            return None
+        return self.ingest()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run a dataset through the provider batch APIs instead of live calls.")
+    parser.add_argument("step", choices=["prepare", "submit", "poll", "ingest", "run"])
+    parser.add_argument("--image-dir", default="dataset/images/train")
+    parser.add_argument("--label-dir", default="dataset/labels/train")
+    parser.add_argument("--shots", type=int, nargs="+", default=[0, 6, 12, 18])
+    parser.add_argument("--zoom-id", default="20")
+    parser.add_argument("--output-dir", default="./results/")
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--task", choices=["classification", "detection"], default="classification")
+    parser.add_argument("--batch-dir", default=pipeline.batch_jobs["dir"],
+                        help="holds requests.jsonl, manifest.json, job.json and results.jsonl")
+    parser.add_argument("--backend", choices=["provider", "local"], default=pipeline.batch_jobs["backend"],
+                        help="'local' runs the job file against api_base_urls (e.g. api/mock_server.py)")
+    parser.add_argument("--journal", default=pipeline.journal_path)
+    parser.add_argument("--timeout", type=float, default=None, help="stop polling after this many seconds")
+    args = parser.parse_args()
+    pipeline.journal_path = args.journal
+    pipeline.batch_jobs = {**pipeline.batch_jobs, "dir": args.batch_dir, "backend": args.backend}
+
+    runner = offline_batch(pipeline, args.image_dir, args.label_dir, args.shots, args.zoom_id, args.output_dir,
+                           args.workers, args.task)
+    if args.step == "run":
+        runner.run(args.timeout)
+    elif args.step == "poll":
+        runner.poll(args.timeout)
+    else:
+        getattr(runner, args.step)()
@@ -0,0 +1,108 @@
+import os
+import queue
+import atexit
+import threading
+
+import cv2
+import numpy as np
+
+
+# BGR, same colors as the old matplotlib plot
+COLORS = {"Round": (0, 0, 255), "Polygonal": (0, 200, 0), "Spindle": (255, 0, 0)}
+PROPOSAL_COLOR = (0, 0, 255)
+
+
+def draw_boxes(image, bboxes, detection_plot=True, thickness=1, labels=True):
+    # Returns a copy of the frame with the boxes drawn on it. `bboxes` is the
+    # {class: [boxes]} dict from the classifier, or a plain box list when
+    # detection_plot is False.
+    canvas = np.ascontiguousarray(image).copy()
+    if canvas.ndim == 2:
+        canvas = cv2.cvtColor(canvas, cv2.COLOR_GRAY2BGR)
+
+    groups = bboxes.items() if detection_plot else [(None, bboxes)]
+    for shape, boxes in groups:
+        color = COLORS.get(shape, PROPOSAL_COLOR)
+        for x1, y1, x2, y2 in boxes:
+            cv2.rectangle(canvas, (int(x1), int(y1)), (int(x2), int(y2)), color, thickness)
+            if labels and shape is not None:
+                cv2.putText(canvas, shape[0], (int(x1) + 2, max(int(y1) - 3, 8)), cv2.FONT_HERSHEY_SIMPLEX,
+                            0.35, color, 1, cv2.LINE_AA)
+    return canvas
+
+
+def make_contact_sheet(tiles, columns=6, tile_size=256, titles=None):
+    # Grid of letterboxed thumbnails, one per image, with an optional caption
+    rows = max(1, -(-len(tiles) // columns))
+    sheet = np.zeros((rows * tile_size, columns * tile_size, 3), dtype=np.uint8)
+    for n, tile in enumerate(tiles):
+        h, w = tile.shape[:2]
+        scale = tile_size / max(h, w)
+        thumb = cv2.resize(tile, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+        y, x = (n // columns) * tile_size, (n % columns) * tile_size
+        sheet[y:y + thumb.shape[0], x:x + thumb.shape[1]] = thumb
+        if titles is not None and titles[n] is not None:
+            cv2.putText(sheet, str(titles[n]), (x + 4, y + 14), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255),
+                        1, cv2.LINE_AA)
+    return sheet
+
+
+class overlay_writer():
+    # Encodes and writes overlays on a background thread. The queue is
+    # bounded, so a slow disk applies backpressure instead of piling up frames.
+    def __init__(self, queue_size=16, jpeg_quality=90):
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.jpeg_quality = jpeg_quality
+        self.sheets = {}
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.worker, daemon=True)
+        self.thread.start()
+        atexit.register(self.flush)
+
+    def worker(self):
+        while True:
+            path, image = self.queue.get()
+            try:
+                if os.path.dirname(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                params = [cv2.IMWRITE_JPEG_QUALITY, self.jpeg_quality] if path.lower().endswith((".jpg", ".jpeg")) else []
+                if not cv2.imwrite(path, image, params):
+                    print(f"Could not write overlay to {path}")
+            except Exception as e:
+                print(f"Could not write overlay to {path}: {e}")
+            finally:
+                self.queue.task_done()
+
+    def submit(self, image, bboxes, save_filename, detection_plot=True, thickness=1, labels=True):
+        # Drawing happens here, on a copy, so the caller may release the frame
+        # (e.g. a shared-memory view) as soon as this returns.
+        canvas = draw_boxes(image, bboxes, detection_plot, thickness, labels)
+        if save_filename is not None:
+            self.queue.put((save_filename, canvas))
+        return canvas
+
+    def add_to_sheet(self, sheet_filename, canvas, title=None, tile_size=256):
+        h, w = canvas.shape[:2]
+        scale = tile_size / max(h, w)
+        thumb = cv2.resize(canvas, (max(1, int(w * scale)), max(1, int(h * scale))), interpolation=cv2.INTER_AREA)
+        with self.lock:
+            self.sheets.setdefault(sheet_filename, []).append((thumb, title))
+
+    def write_sheets(self, columns=6, tile_size=256):
+        with self.lock:
+            sheets, self.sheets = self.sheets, {}
+        for sheet_filename, tiles in sheets.items():
+            sheet = make_contact_sheet([tile for tile, _ in tiles], columns, tile_size, [title for _, title in tiles])
+            self.queue.put((sheet_filename, sheet))
+
+    def flush(self):
+        self.queue.join()
+
+
+_writer = None
+
+def get_overlay_writer(queue_size=16):
+    global _writer
+    if _writer is None:
+        _writer = overlay_writer(queue_size)
+    return _writer
@@ -2,6 +2,9 @@ import os
 import json
     
 def read_keys():
+    # Keys already in the environment (e.g. dummy keys for the mock server) are kept
+    if not os.path.exists('key.json') and 'OPENAI_API_KEY' in os.environ and 'GOOGLE_API_KEY' in os.environ:
+        return
     with open('key.json') as file:
         key = json.load(file)
         openai_key = key["openai"]
@@ -2,39 +2,172 @@ import os
 import cv2
 import random
 import json
+import asyncio
+from itertools import islice
 
 from config import prompts
-from utils import load_image, map_shape_to_bbox, generate_classification_examples
+from utils import load_image, map_shape_to_bbox
 from read_keys import read_keys
 
 from region_proposal import detector
 from api.classification import GPTAPI, GeminiAPI
+from api.cache import get_response_cache
+from api.transport import configure_transport
+from example_bank import load_example_bank
+from encoder import patch_encoder
+from example_index import example_index
+from telemetry import get_telemetry
 
 
 
+def get_classification_api(vlm_model_type="gpt", vlm="gpt-4o-2024-08-06", rate_limits=None, cache=None, resilience=None,
+                           base_urls=None, rate_limit_dir=None):
+    rate_limits = (rate_limits or {}).get(vlm_model_type, {})
+    base_url = (base_urls or {}).get(vlm_model_type)
+    if vlm_model_type=="gpt":
+        return GPTAPI(os.environ["OPENAI_API_KEY"], vlm, cache=cache, resilience=resilience, base_url=base_url,
+                      rate_limit_dir=rate_limit_dir, **rate_limits)
+    if vlm_model_type=="gemini":
+        return GeminiAPI(os.environ["GOOGLE_API_KEY"], vlm, cache=cache, resilience=resilience, base_url=base_url,
+                         rate_limit_dir=rate_limit_dir, **rate_limits)
+    raise ValueError(f"Unknown vlm_model_type: {vlm_model_type}")
+
 
 class classifier():
-    def __init__(self, example_image_dir, example_label_dir, shot=0, target_size = (124, 124)):
+    # Long-lived classification session: keys, the API client (and with it the
+    # rate limiter) and the few-shot examples are set up once and reused for
+    # every patch of every image.
+    def __init__(self, example_image_dir, example_label_dir, shot=0, target_size = (124, 124),
+                 padding=0, vlm_model_type="gpt", vlm="gpt-4o-2024-08-06", rate_limits=None,
+                 cache_path=None, cache_max_bytes=512 * 1024 ** 2, example_bank_dir="./cache/example_bank", example_seed=0,
+                 batch_size=1, encoder=None, resilience=None, base_urls=None, example_selection="random",
+                 rate_limit_dir=None):
         self.shot = shot
         self.prompt = prompts.CELL_CLASSIFICATION
+        self.batch_prompt = prompts.BATCH_CELL_CLASSIFICATION
+        self.batch_size = batch_size
+        self.encoder = patch_encoder(**(encoder or {}))
         self.example_image_dir = example_image_dir
         self.example_label_dir = example_label_dir
         self.target_size = target_size
+        self.padding = padding
+        self.vlm_model_type = vlm_model_type
+        self.vlm = vlm
         read_keys()
+        self.cache = get_response_cache(cache_path, cache_max_bytes)
+        self.api = get_classification_api(vlm_model_type, vlm, rate_limits, self.cache, resilience, base_urls,
+                                          rate_limit_dir)
+        self.example_bank_dir = example_bank_dir
+        self.example_seed = example_seed
+        self.example_bank = None
+        self.example_index = None
+        self.example_selection = example_selection
+        self.examples = {}
+
+    def get_example_bank(self):
+        if self.example_bank is None:
+            self.example_bank = load_example_bank(self.example_image_dir, self.example_label_dir, self.target_size,
+                                                  self.padding, self.example_bank_dir, self.encoder)
+        return self.example_bank
+
+    def get_examples(self, shot=None, patches=None):
+        # With example_selection="knn" and the patches at hand, the examples
+        # are the bank crops nearest to them; otherwise one seeded random draw
+        # per shot count is reused for every request.
+        shot = self.shot if shot is None else shot
+        if shot > 0 and self.example_selection == "knn" and patches:
+            if self.example_index is None:
+                self.example_index = example_index(self.get_example_bank(), self.target_size)
+            return self.example_index.select(patches, shot, self.target_size)
+
+        if shot not in self.examples:
+            if shot > 0:
+                self.examples[shot] = self.get_example_bank().sample(shot, seed=self.example_seed)
+            else:
+                self.examples[shot] = {"Round": [], "Spindle": [], "Polygonal": []}
+        return self.examples[shot]
+
+    def encode(self, patch):
+        with get_telemetry().stage("encode"):
+            return load_image(patch, target_size=self.target_size, encoder=self.encoder)[0]
+
+    def classify(self, patch, shot=None):
+        examples = self.get_examples(shot, [patch])
+        inputs = {"prompt": self.prompt, "image": patch, "mime_type": self.encoder.mime_type}
+        pred_shape = self.api.get_shape_information(inputs, examples)
+
+        return pred_shape
+
+    async def aclassify_all(self, patches, shot=None, max_concurrency=8, batch_size=None, on_result=None, encode=None):
+        # `patches` may be a lazy iterable; when `encode` is given each raw crop
+        # is encoded only once a request slot is free, so memory stays bounded
+        # by max_concurrency * batch_size patches rather than the proposal count.
+        batch_size = max(1, self.batch_size if batch_size is None else batch_size)
+        knn = self.example_selection == "knn"
+        examples = self.get_examples(shot)
+        slots = asyncio.Semaphore(max_concurrency)
+        results = []
+
+        async with self.api.transport.shared_async_session() as http_session:
+            async def classify_one(i, image, examples):
+                inputs = {"prompt": self.prompt, "image": image, "mime_type": self.encoder.mime_type}
+                results[i] = await self.api.aget_shape_information(inputs, examples, http_session)
+                if on_result is not None:
+                    on_result(i, results[i])
+
+            async def classify_batch(batch, examples):
+                try:
+                    if len(batch) > 1:
+                        inputs = {"prompt": self.batch_prompt.format(num_patches=len(batch)),
+                                  "images": [image for _, image in batch], "mime_type": self.encoder.mime_type}
+                        labels = await self.api.aget_shape_information_batch(inputs, examples, http_session)
+                        if labels is not None:
+                            for (i, _), label in zip(batch, labels):
+                                results[i] = label
+                                if on_result is not None:
+                                    on_result(i, label)
+                            return
+                        print(f"Could not map the answer for a batch of {len(batch)} patches, retrying them one by one.")
+                    await asyncio.gather(*[classify_one(i, image, examples) for i, image in batch])
+                finally:
+                    slots.release()
+
+            tasks = []
+            patches = iter(enumerate(patches))
+            while True:
+                chunk = list(islice(patches, batch_size))
+                if not chunk:
+                    break
+                await slots.acquire()
+                if knn:
+                    # one neighbour set per request, from the raw crops of the whole batch
+                    examples = self.get_examples(shot, [patch for _, patch in chunk if patch is not None])
+                batch = []
+                for i, patch in chunk:
+                    results.append(None)
+                    image = encode(patch) if encode is not None and patch is not None else patch
+                    if image is not None:
+                        batch.append((i, image))
+                if batch:
+                    tasks.append(asyncio.create_task(classify_batch(batch, examples)))
+                else:
+                    slots.release()
+
+            # results are written by index, so they stay in proposal order
+            await asyncio.gather(*tasks)
 
-    def classify(self, patch, padding=0, vlm_model_type="gpt", vlm="gpt-4o-2024-08-06"):
-        if vlm_model_type=="gpt":
-            api_key = os.environ["OPENAI_API_KEY"]
-            api = GPTAPI(api_key, vlm)
-            
-        if vlm_model_type=="gemini":
-            api_key = os.environ["GOOGLE_API_KEY"]
-            api = GeminiAPI(api_key, vlm)
+        return results
 
-            examples = generate_classification_examples(shots=self.shot, example_image_dir = self.example_image_dir, 
-                                              example_label_dir = self.example_label_dir, target_size=self.target_size, offset=padding)
+    def classify_all(self, patches, shot=None, max_concurrency=8, batch_size=None, on_result=None, encode=None):
+        return asyncio.run(self.aclassify_all(patches, shot, max_concurrency, batch_size, on_result, encode))
 
-            inputs = {"prompt": self.prompt, "image": patch}
-            pred_shape = api.get_shape_information(inputs, examples)
 
-        return pred_shape
\ No newline at end of file
+def get_session(config):
+    http = dict(config.http)
+    http["pool_size"] = http.get("pool_size") or config.max_concurrency
+    configure_transport(**http)
+    return classifier(config.example_image_dir, config.example_label_dir, config.shot, config.target_size,
+                      config.padding, config.vlm_model_type, config.vlm, config.rate_limits,
+                      config.cache_path, config.cache_max_bytes, config.example_bank_dir, config.example_seed,
+                      config.batch_size, config.encoder, config.resilience, config.api_base_urls,
+                      config.example_selection, config.rate_limit_dir)
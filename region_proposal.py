@@ -2,48 +2,153 @@ import os
 import cv2
 import config
 import ast
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 from utils import load_image, plot, get_min_max_area, generate_detection_examples
 from metric import detector_iou
 from config import prompts
 from read_keys import read_keys
 
+import torch
+import numpy as np
 import selective_search
 from segment_anything import sam_model_registry, SamAutomaticMaskGenerator
-from api.detection import GeminiAPI
+from api.detection import GPTAPI, GeminiAPI
+from api.cache import get_response_cache
+from box_ops import nms, box_area
+from shape_prior import crop_mask
+from telemetry import get_telemetry
 
 
+# SAM mask generators loaded in this process, keyed by (model type, checkpoint, device)
+_sam_models = {}
+
+
+def get_device(device=None):
+    if device is None:
+        return "cuda" if torch.cuda.is_available() else "cpu"
+    return device
+
+
+def get_mask_generator(sam_checkpoint, sam_model_type, device=None, num_threads=None):
+    device = get_device(device)
+    if num_threads:
+        torch.set_num_threads(num_threads)
+    key = (sam_model_type, sam_checkpoint, device)
+    if key not in _sam_models:
+        sam = sam_model_registry[sam_model_type](checkpoint=sam_checkpoint)
+        sam.to(device)
+        sam.eval()
+        _sam_models[key] = SamAutomaticMaskGenerator(sam)
+    return _sam_models[key]
+
+
+def get_tiles(height, width, tile_size, overlap):
+    # Overlapping (x1, y1, x2, y2) windows covering the image; the last row and
+    # column are shifted back so every tile is full size where possible.
+    stride = max(1, tile_size - overlap)
+    xs = list(range(0, max(width - tile_size, 0) + 1, stride))
+    ys = list(range(0, max(height - tile_size, 0) + 1, stride))
+    if xs[-1] + tile_size < width:
+        xs.append(width - tile_size)
+    if ys[-1] + tile_size < height:
+        ys.append(height - tile_size)
+    return [(x, y, min(x + tile_size, width), min(y + tile_size, height)) for y in ys for x in xs]
+
 
 class detector():
-    def __init__(self, img_path):
-        self.img = cv2.imread(img_path)
+    def __init__(self, img_path=None, image=None):
+        self.img = image if image is not None else cv2.imread(img_path)
         self.bbox = None
 
-    def get_all_bbox_sam(self, sam_checkpoint, sam_model_type, padding, min_area=None, max_area=None):
-        sam = sam_model_registry[sam_model_type](checkpoint=sam_checkpoint)
-        sam.to("cuda")
-        mask_generator = SamAutomaticMaskGenerator(sam)
-        
-        masks = mask_generator.generate(self.img)
+    def get_all_bbox_sam(self, sam_checkpoint, sam_model_type, padding, min_area=None, max_area=None,
+                         device=None, num_threads=None, return_masks=False):
+        with get_telemetry().stage("sam_load"):
+            mask_generator = get_mask_generator(sam_checkpoint, sam_model_type, device, num_threads)
+
+        with get_telemetry().stage("sam_generate"):
+            masks = mask_generator.generate(self.img)
 
+        boxes = [[m["bbox"][0], m["bbox"][1], m["bbox"][0]+m["bbox"][2], m["bbox"][1]+m["bbox"][3]] for m in masks]
+        bounding_boxes, index = self.pad_boxes(boxes, padding, min_area, max_area, return_index=True)
+        if return_masks:
+            # cropped to the unpadded box, aligned with the returned boxes
+            return bounding_boxes, [crop_mask(masks[i]["segmentation"], boxes[i]) for i in index]
+        return bounding_boxes
+
+    def pad_boxes(self, boxes, padding, min_area=None, max_area=None, return_index=False):
+        height, width = self.img.shape[:2]
         bounding_boxes = []
-        for mask in masks:
-            x1, y1, x2, y2 = mask["bbox"][0], mask["bbox"][1], mask["bbox"][0]+mask["bbox"][2], mask["bbox"][1]+mask["bbox"][3]
-            x1, y1, x2, y2 = max(0, x1-padding), max(0, y1-padding), min( self.img.shape[0], x2+padding), min( self.img.shape[1], y2+padding)
+        index = []
+        for i, (x1, y1, x2, y2) in enumerate(boxes):
+            x1, y1, x2, y2 = max(0, x1-padding), max(0, y1-padding), min(width, x2+padding), min(height, y2+padding)
             box_area = (x2-x1)*(y2-y1)
-            if min_area and min_area:
+            if min_area and max_area:
                 if (box_area > min_area) and (box_area < max_area):
                     bounding_boxes.append([x1, y1, x2, y2])
+                    index.append(i)
             else:
                 bounding_boxes.append([x1, y1, x2, y2])
-            
+                index.append(i)
+
+        if return_index:
+            return bounding_boxes, index
+        return bounding_boxes
+
+    def get_all_bbox_sam_tiled(self, sam_checkpoint, sam_model_type, padding, min_area=None, max_area=None,
+                               device=None, num_threads=None, tile_size=1024, overlap=256, tile_workers=1,
+                               iou_threshold=0.5, return_masks=False):
+        # SAM on overlapping tiles, so peak memory follows the tile size rather
+        # than the image size. Masks cut by an interior tile edge are dropped
+        # (the neighbouring tile sees them whole as long as overlap exceeds the
+        # cell size) and duplicates from the overlaps are merged with NMS.
+        with get_telemetry().stage("sam_load"):
+            mask_generator = get_mask_generator(sam_checkpoint, sam_model_type, device, num_threads)
+        height, width = self.img.shape[:2]
+        local = threading.local()
+
+        def run_tile(tile):
+            if not hasattr(local, "generator"):
+                # one generator per thread; they share the loaded model weights
+                local.generator = mask_generator if tile_workers == 1 else SamAutomaticMaskGenerator(mask_generator.predictor.model)
+            x0, y0, x1, y1 = tile
+            with get_telemetry().stage("sam_generate_tile"):
+                masks = local.generator.generate(np.ascontiguousarray(self.img[y0:y1, x0:x1]))
+
+            boxes = []
+            for mask in masks:
+                bx, by, bw, bh = mask["bbox"]
+                cut = ((bx <= 0 and x0 > 0) or (by <= 0 and y0 > 0) or
+                       (bx + bw >= x1 - x0 and x1 < width) or (by + bh >= y1 - y0 and y1 < height))
+                if not cut:
+                    cropped = crop_mask(mask["segmentation"], [bx, by, bx + bw, by + bh]) if return_masks else None
+                    boxes.append(([bx + x0, by + y0, bx + bw + x0, by + bh + y0], cropped))
+            return boxes
+
+        tiles = get_tiles(height, width, tile_size, overlap)
+        if tile_workers > 1:
+            with ThreadPoolExecutor(tile_workers) as pool:
+                tile_boxes = list(pool.map(run_tile, tiles))
+        else:
+            tile_boxes = [run_tile(tile) for tile in tiles]
+
+        boxes = [box for tile in tile_boxes for box, _ in tile]
+        masks = [mask for tile in tile_boxes for _, mask in tile]
+        if boxes:
+            keep = sorted(nms(boxes, box_area(boxes), iou_threshold))
+            boxes, masks = [boxes[i] for i in keep], [masks[i] for i in keep]
+        bounding_boxes, index = self.pad_boxes(boxes, padding, min_area, max_area, return_index=True)
+        if return_masks:
+            return bounding_boxes, [masks[i] for i in index]
         return bounding_boxes
     
     def get_all_bbox_selective_search(self, max_box, min_area=None, max_area=None):
-        boxes = selective_search.selective_search(self.img, mode='single', random_sort=False)
+        with get_telemetry().stage("selective_search"):
+            boxes = selective_search.selective_search(self.img, mode='single', random_sort=False)
         box_filter = []
 
-        if min_area and min_area:
+        if min_area and max_area:
             for box in boxes:
                 box_area = (box[2]-box[0]) * (box[3]-box[1])
                 if (box_area > min_area) and (box_area < max_area):
@@ -54,16 +159,17 @@ class detector():
 
         return box_filter
     
-    def get_all_bbox_api(self, model_type="gpt", vlm="gpt-4o-2024-08-06", example_image_dir=None, example_label_dir=None, target_size=(124, 124), shots=0):
+    def get_all_bbox_api(self, model_type="gpt", vlm="gpt-4o-2024-08-06", example_image_dir=None, example_label_dir=None, target_size=(124, 124), shots=0, cache_path=None, base_url=None, rate_limit_dir=None):
 
         read_keys()
+        cache = get_response_cache(cache_path)
         
         if model_type=="gpt":
             api_key = os.environ["OPENAI_API_KEY"]
-            api = GPTAPI(api_key, vlm)
+            api = GPTAPI(api_key, vlm, cache=cache, base_url=base_url, rate_limit_dir=rate_limit_dir)
         if model_type=="gemini":
             api_key = os.environ["GOOGLE_API_KEY"]
-            api = GeminiAPI(api_key, vlm)
+            api = GeminiAPI(api_key, vlm, cache=cache, base_url=base_url, rate_limit_dir=rate_limit_dir)
             
         #prompt = prompts.DETECTION_CLASSIFICATION
         prompt = prompts.SINGLE_CLASS_DETECTION_CLASSIFICATION
@@ -90,7 +196,9 @@ if __name__=="__main__":
     example_image_dir="./dataset/images/train"
     example_label_dir="./dataset/labels/train"
     
-    preds = detector(img_path).get_all_bbox_api(model_type, vlm, example_image_dir, example_label_dir, target_size=(124, 124), shots=3)
+    preds = detector(img_path).get_all_bbox_api(model_type, vlm, example_image_dir, example_label_dir, target_size=(124, 124), shots=3,
+                                                cache_path=config.pipeline.cache_path,
+                                                rate_limit_dir=config.pipeline.rate_limit_dir)
     plot(img_path, preds, 
          save_filename="/work/mech-ai-scratch/shreyang/AFM/SAM_VLM_API/results/test/gemini.png", target_size=(124, 124))
     
@@ -0,0 +1,87 @@
+import cv2
+import numpy as np
+
+
+SHAPES = ["Round", "Spindle", "Polygonal"]
+
+
+def crop_mask(segmentation, box):
+    # SAM returns full-frame masks; only the part under the (unpadded) box is kept
+    x1, y1, x2, y2 = [int(v) for v in box]
+    return np.ascontiguousarray(segmentation[y1:y2, x1:x2]).astype(np.uint8)
+
+
+def chain_perimeter(contour):
+    # Length of a closed 8-connected pixel contour with the Vossepoel-Smeulders
+    # weights. cv2.arcLength counts every staircase step at full length and
+    # overestimates the perimeter of smooth shapes by ~6%, more on small masks.
+    points = contour.reshape(-1, 2)
+    steps = np.roll(points, -1, axis=0) - points
+    diagonal = np.abs(steps).sum(axis=1) == 2
+    direction = steps[:, 0] * 3 + steps[:, 1]
+    corners = np.count_nonzero(direction != np.roll(direction, 1))
+    return 0.980 * np.count_nonzero(~diagonal) + 1.406 * np.count_nonzero(diagonal) - 0.091 * corners
+
+
+def mask_descriptors(masks):
+    # Per-mask shape descriptors as arrays of len(masks):
+    #   circularity  4*pi*area / perimeter^2 (~1 for a disc of any size)
+    #   aspect       long / short side of the minimum-area rectangle
+    #   solidity     area / convex hull area
+    #   defect       deepest convexity defect relative to the equivalent diameter
+    # Masks without a usable contour get NaN and are never pre-classified.
+    descriptors = np.full((len(masks), 4), np.nan)
+    for i, mask in enumerate(masks):
+        if mask is None or not mask.any():
+            continue
+        contours, _ = cv2.findContours(mask, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_NONE)
+        contour = max(contours, key=cv2.contourArea)
+        area = cv2.contourArea(contour)
+        perimeter = chain_perimeter(contour)
+        if area < 16 or perimeter == 0:
+            continue
+        (_, _), (w, h), _ = cv2.minAreaRect(contour)
+        hull_area = cv2.contourArea(cv2.convexHull(contour))
+
+        depth = 0.0
+        hull = cv2.convexHull(contour, returnPoints=False)
+        if len(hull) > 3:
+            try:
+                defects = cv2.convexityDefects(contour, hull)
+                if defects is not None:
+                    depth = defects.reshape(-1, 4)[:, 3].max() / 256.0
+            except cv2.error:
+                pass  # self-intersecting hull indices on degenerate contours
+
+        descriptors[i] = [4 * np.pi * area / perimeter ** 2, max(w, h) / max(min(w, h), 1e-6),
+                          area / max(hull_area, 1e-6), depth / np.sqrt(4 * area / np.pi)]
+    return descriptors
+
+
+def sigmoid(x):
+    return 1.0 / (1.0 + np.exp(-x))
+
+
+def shape_scores(descriptors):
+    # Soft per-class scores in [0, 1], one column per entry of SHAPES. Each is
+    # a product of logistic ramps, so a score is only high when every
+    # descriptor agrees.
+    circularity, aspect, solidity, defect = descriptors.T
+    with np.errstate(invalid="ignore", over="ignore"):
+        round_score = sigmoid((circularity - 0.89) / 0.02) * sigmoid((1.3 - aspect) / 0.06) * sigmoid((solidity - 0.89) / 0.015)
+        spindle_score = sigmoid((aspect - 2.6) / 0.2) * sigmoid((solidity - 0.85) / 0.03)
+        polygonal_score = (sigmoid((0.88 - solidity) / 0.02) * sigmoid((1.8 - aspect) / 0.15)
+                           * sigmoid((defect - 0.12) / 0.03))
+    return np.nan_to_num(np.stack([round_score, spindle_score, polygonal_score], axis=1))
+
+
+def pre_classify(masks, threshold=0.9):
+    # One label per mask when the best score passes `threshold`, else None
+    # (the proposal is ambiguous and still goes to the VLM).
+    if not len(masks):
+        return [], np.zeros(0)
+    scores = shape_scores(mask_descriptors(masks))
+    best = scores.argmax(axis=1)
+    confidence = scores[np.arange(len(masks)), best]
+    labels = [SHAPES[b] if c >= threshold else None for b, c in zip(best, confidence)]
+    return labels, confidence
@@ -0,0 +1,156 @@
+import os
+import json
+import time
+import pstats
+import cProfile
+import threading
+from contextlib import contextmanager
+
+import numpy as np
+
+
+def metric_key(name, labels):
+    return (name, tuple(sorted(labels.items())))
+
+
+def format_key(key):
+    name, labels = key
+    if not labels:
+        return name
+    return name + "{" + ",".join(f'{label}="{value}"' for label, value in labels) + "}"
+
+
+class telemetry():
+    # Process-wide counters and stage timers. Everything is kept in memory and
+    # only written out on request, so instrumented code pays a dict update
+    # under a lock per event.
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.timers = {}
+        self.log_file = None
+
+    def count(self, name, value=1, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, seconds, **labels):
+        key = metric_key(name, labels)
+        with self.lock:
+            self.timers.setdefault(key, []).append(seconds)
+
+    @contextmanager
+    def stage(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_seconds", time.perf_counter() - start, stage=name, **labels)
+
+    def drain(self):
+        # Picklable copy that is reset afterwards; worker processes hand this
+        # back to the parent, which merges it.
+        with self.lock:
+            state = {"counters": self.counters, "timers": self.timers}
+            self.counters, self.timers = {}, {}
+        return state
+
+    def merge(self, state):
+        with self.lock:
+            for key, value in state["counters"].items():
+                self.counters[key] = self.counters.get(key, 0) + value
+            for key, values in state["timers"].items():
+                self.timers.setdefault(key, []).extend(values)
+
+    def snapshot(self):
+        with self.lock:
+            counters = {format_key(key): value for key, value in self.counters.items()}
+            timers = {}
+            for key, values in self.timers.items():
+                values = np.asarray(values)
+                p50, p95 = np.percentile(values, [50, 95])
+                timers[format_key(key)] = {"count": int(values.size), "total": float(values.sum()),
+                                           "p50": float(p50), "p95": float(p95), "max": float(values.max())}
+        return {"counters": counters, "timers": timers}
+
+    def open_log(self, path):
+        if self.log_file is not None and self.log_file.name == path:
+            return
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.log_file = open(path, "a")
+
+    def log(self, event, **fields):
+        # One JSON object per line; a no-op until open_log has been called
+        if self.log_file is None:
+            return
+        record = {"time": time.time(), "event": event, **fields}
+        with self.lock:
+            self.log_file.write(json.dumps(record) + "\n")
+            self.log_file.flush()
+
+    def write_prometheus(self, path):
+        # Text exposition format, e.g. for the node_exporter textfile collector
+        lines = []
+        with self.lock:
+            for name in sorted({key[0] for key in self.counters}):
+                lines.append(f"# TYPE vlm_{name} counter")
+                for key, value in sorted(self.counters.items()):
+                    if key[0] == name:
+                        lines.append(f"vlm_{format_key(key)} {value}")
+            for name in sorted({key[0] for key in self.timers}):
+                lines.append(f"# TYPE vlm_{name} summary")
+                for key, values in sorted(self.timers.items()):
+                    if key[0] != name:
+                        continue
+                    labels = key[1]
+                    for quantile in (0.5, 0.95):
+                        quantile_key = (name, labels + (("quantile", str(quantile)),))
+                        lines.append(f"vlm_{format_key(quantile_key)} {np.percentile(values, quantile * 100):.6f}")
+                    lines.append(f"vlm_{format_key((name + '_sum', labels))} {sum(values):.6f}")
+                    lines.append(f"vlm_{format_key((name + '_count', labels))} {len(values)}")
+
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path + ".tmp", "w") as file:
+            file.write("\n".join(lines) + "\n")
+        os.replace(path + ".tmp", path)
+
+    def write(self, config):
+        # Flushes the run summary to whatever config.telemetry asks for
+        settings = config.telemetry
+        if settings.get("log_path"):
+            self.open_log(settings["log_path"])
+            self.log("summary", **self.snapshot())
+        if settings.get("metrics_path"):
+            self.write_prometheus(settings["metrics_path"])
+
+
+_telemetry = telemetry()
+
+def get_telemetry():
+    return _telemetry
+
+
+_profiled = False
+
+@contextmanager
+def profile_once(path):
+    # cProfile around the first call in this process only, so a batch run
+    # profiles one representative image instead of paying the overhead on all.
+    global _profiled
+    if path is None or _profiled:
+        yield
+        return
+    _profiled = True
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        profiler.dump_stats(path)
+        pstats.Stats(profiler).sort_stats("cumulative").print_stats(15)